@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Benchmark of a CPU-bound rule set on clusters of increasing size.
+
+Runs the rules in benchmarks/cpu_rules.py on a number of contexts spread over
+1, 2, 4, ... worker processes (up to the number of cores) and reports the
+throughput of each cluster size. Run from the repository root:
+
+    python3 benchmarks/cluster.py
+"""
+import os
+import os.path
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from eca import Event
+from eca.cluster import Cluster
+
+RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cpu_rules.py')
+
+
+def run(processes, contexts=16, events=50, iterations=20000):
+    """Returns the number of events handled per second."""
+    cluster = Cluster(RULES, processes)
+
+    remaining = [contexts * events]
+    finished = threading.Event()
+    lock = threading.Lock()
+
+    def done(topic, data):
+        with lock:
+            remaining[0] -= 1
+            if not remaining[0]:
+                finished.set()
+
+    stand_ins = []
+    for i in range(contexts):
+        context = cluster.spawn_context(name='context-{}'.format(i))
+        context.channel.subscribe(done, 'emit')
+        stand_ins.append(context)
+
+    # warm up: make sure all processes have imported the rules
+    time.sleep(1.0)
+
+    start = time.perf_counter()
+    for i in range(events):
+        for context in stand_ins:
+            context.receive_event(Event('work', {'iterations': iterations}))
+    finished.wait()
+    elapsed = time.perf_counter() - start
+
+    cluster.stop()
+    return contexts * events / elapsed
+
+
+def main():
+    cores = os.cpu_count() or 1
+    sizes = [1]
+    while sizes[-1] * 2 <= cores:
+        sizes.append(sizes[-1] * 2)
+
+    print("{:>10} {:>14} {:>10}".format('processes', 'events/s', 'speedup'))
+    base = None
+    for processes in sizes:
+        throughput = run(processes)
+        base = base or throughput
+        print("{:>10} {:>14.1f} {:>10.2f}".format(processes, throughput, throughput / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+"""
+CPU-bound rule set used by benchmarks/cluster.py.
+"""
+from eca import *
+
+
+@event('work')
+def work(ctx, e):
+    # burn some CPU the way a tokenizer or classifier would
+    total = 0
+    for i in range(e.data['iterations']):
+        total += i * i % 7
+    emit('done', total)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Benchmark of rule dispatch cost as the number of rules grows.
+
+Compares the indexed lookup of candidate rules with a full scan of the rule
+set. Run from the repository root:
+
+    python3 benchmarks/dispatch.py
+"""
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from eca import Rules, Event
+
+
+def build_rules(count, events=10):
+    """Builds a rules set with count rules spread over a number of events."""
+    rules = Rules()
+    for i in range(count):
+        def action(ctx, e):
+            pass
+        action.__name__ = 'action_{}'.format(i)
+        rules.event('event{}'.format(i % events))(action)
+    return rules
+
+
+def main():
+    event = Event('event0', {})
+    print("{:>8} {:>14} {:>14}".format('rules', 'scan (us)', 'index (us)'))
+    for count in [10, 100, 1000, 10000]:
+        rules = build_rules(count)
+        number = max(100, 100000 // count)
+
+        scan = timeit.timeit(lambda: [r for r in rules.rules if event.name in r.events], number=number)
+        index = timeit.timeit(lambda: rules.lookup(event.name), number=number)
+
+        print("{:>8} {:>14.3f} {:>14.3f}".format(count, scan / number * 1e6, index / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
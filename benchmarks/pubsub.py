@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Benchmark of publish contention on a single PubSubChannel.
+
+Many publisher threads publish to the same channel, whose subscribers block
+briefly (as a slow subscriber doing I/O would). The copy-on-write channel is
+compared with a channel that holds a lock while calling subscribers. Run
+from the repository root:
+
+    python3 benchmarks/pubsub.py
+"""
+import os.path
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from eca.pubsub import PubSubChannel
+
+
+class LockedChannel(PubSubChannel):
+    """Channel that serializes publishers, as the channel used to."""
+    def publish(self, event='message', data=None, delay=None):
+        with self.lock:
+            for target in self.subscriptions.get(event, ()):
+                target(event, data)
+
+
+def slow_subscriber(event, data):
+    time.sleep(0.0001)
+
+
+def run(channel, publishers, messages):
+    """Returns the number of publishes per second."""
+    for i in range(4):
+        channel.subscribe(slow_subscriber, 'event')
+
+    def publisher():
+        for i in range(messages):
+            channel.publish('event', i)
+
+    threads = [threading.Thread(target=publisher) for i in range(publishers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return publishers * messages / (time.perf_counter() - start)
+
+
+def main():
+    messages = 200
+    print("{:>10} {:>16} {:>16}".format('publishers', 'locked (msg/s)', 'cow (msg/s)'))
+    for publishers in [1, 2, 4, 8, 16]:
+        locked = run(LockedChannel(), publishers, messages)
+        cow = run(PubSubChannel(), publishers, messages)
+        print("{:>10} {:>16.0f} {:>16.0f}".format(publishers, locked, cow))
+
+
+if __name__ == '__main__':
+    main()
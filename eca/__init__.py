@@ -1,13 +1,22 @@
-import queue
 import collections
+import contextvars
+import itertools
+import inspect
+import asyncio
 import threading
 import logging
+import time
 import sys
 import json
 
 from contextlib import contextmanager
 from . import util
 from . import pubsub
+from . import queues
+from . import tracing
+from . import metrics
+from . import fields
+from .fields import field_equals, field_in, field_range
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +24,9 @@ logger = logging.getLogger(__name__)
 __all__ = [
     'event',
     'condition',
+    'field_equals',
+    'field_in',
+    'field_range',
     'rules',
     'Rules',
     'Context',
@@ -34,16 +46,36 @@ __all__ = [
 # The global event channel
 global_channel = pubsub.PubSubChannel()
 
-# The thread local storage used to create a 'current context' with regards
-# to the executing thread.
-# (See https://docs.python.org/3/library/threading.html#thread-local-data)
-thread_local = threading.local()
+# The context variable used to create a 'current context' with regards to the
+# executing thread or asyncio task.
+# (See https://docs.python.org/3/library/contextvars.html)
+current_context = contextvars.ContextVar('eca_context', default=None)
+
+# Set while a context handles events, so events created by its rules, windows
+# and patterns can be told apart from events that come from outside.
+handling = contextvars.ContextVar('eca_handling', default=False)
+
+# The executor used for daemon contexts that are started without an explicit
+# executor. If this is None, each context gets its own thread.
+default_executor = None
 
 
 class Rules:
     def __init__(self):
         self.rules = set()
 
+        # declaration order of each rule, used to keep dispatch deterministic
+        self.order = {}
+
+        # index of event name to the rules attached to that event
+        self.index = {}
+
+        # conditions declared as cheap are evaluated before all others
+        self.cheap = set()
+
+        # evaluation plans per event name, built on first use
+        self.plans = {}
+
     def prepare_action(self, fn):
         """
         Prepares a function to be usable as an action.
@@ -56,15 +88,137 @@ class Rules:
             logger.info("Defined action '{}'".format(fn.__name__))
         fn.conditions = getattr(fn, 'conditions', [])
         fn.events = getattr(fn, 'events', set())
+        if fn not in self.order:
+            self.order[fn] = len(self.order)
         self.rules.add(fn)
-    
-    
-    def condition(self, c):
+
+        # (re)index the rule for all events it is already attached to
+        for eventname in fn.events:
+            self._index_rule(eventname, fn)
+
+    def _index_rule(self, eventname, fn):
+        """
+        Adds the rule to the index of the given event name.
+
+        The indexed rules are kept in declaration order, so that rules are
+        always considered in the same order for the same event.
+        """
+        candidates = self.index.setdefault(eventname, [])
+        if fn not in candidates:
+            candidates.append(fn)
+            candidates.sort(key=self.order.__getitem__)
+        self.plans.pop(eventname, None)
+
+    def lookup(self, eventname):
+        """
+        Returns the rules attached to the given event name.
+
+        The rules are returned in declaration order.
+        """
+        return self.index.get(eventname, ())
+
+    def event_names(self):
+        """Returns the names of all events that have rules attached."""
+        return frozenset(self.index)
+
+    def plan(self, eventname):
+        """
+        Returns the condition evaluation plan for the given event name.
+
+        The plan is a pair of (discriminators, unkeyed). Each rule that has a
+        field test with a finite set of passing values is keyed on the first
+        such test: discriminators maps the field name to a dictionary of field
+        values to the rules keyed on that field that pass for that value. The
+        unkeyed rules are considered for every event.
+
+        Rules are given as (order, rule, conditions) triples, where order is
+        the declaration order of the rule. The conditions of each rule leave
+        out the test the rule is keyed on, and are ordered so that field tests
+        and conditions declared as cheap come first.
+        """
+        try:
+            return self.plans[eventname]
+        except KeyError:
+            pass
+
+        def cost(c):
+            return 0 if id(c) in self.cheap or isinstance(c, fields.FieldTest) else 1
+
+        discriminators = {}
+        unkeyed = []
+        for r in self.lookup(eventname):
+            key = None
+            for c in r.conditions:
+                if isinstance(c, fields.FieldTest) and c.values is not None:
+                    key = c
+                    break
+
+            conditions = tuple(sorted((c for c in r.conditions if c is not key), key=cost))
+            entry = (self.order[r], r, conditions)
+            if key is None:
+                unkeyed.append(entry)
+            else:
+                table = discriminators.setdefault(key.field, {})
+                for value in key.values:
+                    table.setdefault(value, []).append(entry)
+
+        plan = (discriminators, tuple(unkeyed))
+        self.plans[eventname] = plan
+        return plan
+
+    def match(self, scope, event, rejected=None):
+        """
+        Generates the rules for which all conditions hold for the given event.
+
+        If given, rejected is called with each rule of which the conditions do
+        not hold. Rules that the discrimination index rules out by their field
+        tests are never considered, and are not reported.
+
+        Conditions are evaluated lazily: evaluation of a rule's conditions
+        stops at the first failing condition. Each distinct condition is
+        evaluated at most once per event, and its result is reused for all
+        rules sharing that condition. Note that reused results are not
+        re-evaluated after an action of an earlier rule has changed the scope.
+        """
+        discriminators, candidates = self.plan(event.name)
+        if discriminators:
+            candidates = list(candidates)
+            for field, table in discriminators.items():
+                try:
+                    hits = table.get(fields.value(event, field))
+                except TypeError:
+                    # unhashable values never equal a constant in the index
+                    continue
+                if hits:
+                    candidates.extend(hits)
+            candidates.sort()
+
+        results = {}
+        for order, r, conditions in candidates:
+            for c in conditions:
+                key = id(c)
+                try:
+                    holds = results[key]
+                except KeyError:
+                    holds = results[key] = bool(c(scope, event))
+                if not holds:
+                    if rejected is not None:
+                        rejected(r)
+                    break
+            else:
+                yield r
+
+    def condition(self, c, cheap=False):
         """
         Adds a condition callable to the action.
     
         The condition must be callable. The condition will receive a context and
         an event, and must return True or False.
+
+        Conditions that are declared cheap are evaluated before the other
+        conditions of the action. Declarative field tests (see field_equals,
+        field_in and field_range) are always cheap, and rules are indexed on
+        their equality tests so they are only considered for matching events.
     
         This function returns a decorator so we can pass an argument to the
         decorator itself. This is why we define a new function and return it
@@ -77,6 +231,9 @@ class Rules:
             self.prepare_action(fn)
             logger.debug("With condition: {}".format(util.describe_function(c)))
             fn.conditions.append(c)
+            if cheap:
+                self.cheap.add(id(c))
+            self.plans.clear()
             return fn
         return condition_decorator
     
@@ -95,6 +252,7 @@ class Rules:
             self.prepare_action(fn)
             logger.debug("Attached to event: {}".format(eventname))
             fn.events.add(eventname)
+            self._index_rule(eventname, fn)
             return fn
         return event_decorator
 
@@ -105,9 +263,22 @@ rules = Rules()
 event = rules.event
 condition = rules.condition
 
+# Per-process sequence numbers for events
+event_sequence = itertools.count()
+
+
 class Event:
-    """Abstract event with a name and attributes."""
-    def __init__(self, name, data=None):
+    """
+    Abstract event with a name and attributes.
+
+    Besides its name and data, every event carries the monotonic time of its
+    creation, a per-process sequence number and a priority. Events created
+    while a context handles events are derived; all others come from outside.
+    Events use slots to keep them small, as many of them are created.
+    """
+    __slots__ = ('name', 'data', 'timestamp', 'sequence', 'priority', 'derived')
+
+    def __init__(self, name, data=None, priority=0):
         """Constructs an event.
 
         Attributes are optional.
@@ -115,6 +286,10 @@ class Event:
         """
         self.name = name
         self.data = data
+        self.timestamp = time.monotonic()
+        self.sequence = next(event_sequence)
+        self.priority = priority
+        self.derived = handling.get()
 
     def get(self, *args, **kwargs):
         return self.data.get(*args, **kwargs)
@@ -135,13 +310,31 @@ class Context:
 
     Each context maintains both a variables namespace and an event queue. The
     context itself provides a run method to allow threaded execution through
-    starting a new thread targetted at the run method.
+    starting a new thread targetted at the run method. Alternatively, the
+    context can be run on a shared ContextExecutor or AsyncEngine.
 
     Every context also contains a dictionary of auxiliaries which contains
     objects to support the context and its rule execution.
+
+    The event queue can be bounded by a capacity, in which case the overflow
+    policy determines what happens to events received by a full queue (see
+    eca.queues.EventQueue). Threads that handle events never block on a full
+    queue, regardless of the policy.
+
+    Events are handled in batches of at most batch_size events, so that events
+    with a higher priority never wait for more than one batch.
+
+    If a checkpointer is given, the scope is restored from the last
+    checkpoint of a context with the same name. A restored context receives a
+    'restore' event instead of 'init' if its rules handle 'restore'.
+
+    If a journal is given, every event accepted by the context after its
+    initialisation is recorded in it.
     """
-    def __init__(self, init_data=None, name='<unnamed context>', rules=rules):
-        self.event_queue = queue.Queue()
+    batch_size = 100
+
+    def __init__(self, init_data=None, name='<unnamed context>', rules=rules, capacity=None, overflow=queues.BLOCK, checkpointer=None, journal=None):
+        self.event_queue = queues.EventQueue(capacity, overflow)
         self.scope = util.NamespaceDict()
         self.channel = pubsub.PubSubChannel()
         self.auxiliaries = {}
@@ -149,73 +342,250 @@ class Context:
         self.done = False
         self.daemon = True
         self.rules = rules
+        self.executor = None
+        self.checkpointer = checkpointer
+        self.journal = None
+
+        # emits made while handling an event, published together afterwards
+        self.emits = None
+
+        # register with the metrics registry if metrics are enabled
+        registry = metrics.registry
+        self.metrics = registry.context(self) if registry is not None else None
+        self._rejected = registry.rejected if registry is not None else None
+
+        # restore the scope from the last checkpoint
+        init_name = 'init'
+        if checkpointer is not None and checkpointer.attach(self):
+            if 'restore' in self.rules.event_names():
+                init_name = 'restore'
 
         # subscribe to own pubsub channel to receive events
         self.channel.subscribe(self._pubsub_receiver, 'event')
-        self.receive_event(Event('init', init_data))
+        self.receive_event(Event(init_name, init_data))
 
-        # subscribe to global pubsub channel to receive global eca events
-        global_channel.subscribe(self._pubsub_receiver, 'event')
+        # the init event is not journaled, as a replay target is initialised
+        self.journal = journal
 
-    def _trace(self, message):
-        """Prints tracing statements if trace is enabled."""
-        logging.getLogger('trace').info(message)
+        # subscribe to global pubsub channel to receive global eca events, but
+        # only for the events handled by the rules (rules declared after the
+        # context is created are not taken into account)
+        self.interest = self.rules.event_names()
+        global_channel.subscribe(self._pubsub_receiver, 'event', self.interest)
 
     def _pubsub_receiver(self, name, data):
         """Pubsub channel connector."""
         self.receive_event(data)
 
-    def receive_event(self, event):
-        """Receives an Event to handle."""
-        self._trace("Received event: {}".format(event))
-        self.event_queue.put(event)
+    def receive_event(self, event, policy=None):
+        """
+        Receives an Event to handle.
+
+        The optional overflow policy overrides the policy of the event queue.
+        """
+        if tracing.recorder is not None:
+            tracing.recorder.received(self, event)
+        if self._enqueue(event, policy) and self.journal is not None:
+            self.journal.record(self, event)
+
+    def _enqueue(self, item, policy=None):
+        """
+        Puts an item on the event queue and wakes up the executor.
+
+        Returns False if the item was dropped.
+        """
+        accepted = self.event_queue.put(item, policy)
+        if self.executor is not None:
+            self.executor.notify(self)
+        return accepted
 
     def auxiliary(self, name):
         return self.auxiliaries[name]
 
     def run(self):
         """Main event loop."""
+        queues.never_block()
+
         # switch context to this one and start working
         with context_switch(self):
             while not self.done:
-                self._handle_event()
+                self._handle_events(self.event_queue.drain(limit=self.batch_size))
 
-    def start(self, daemon=True):
-        thread = threading.Thread(target=self.run)
+    def run_pending(self):
+        """Handles all pending events without waiting for new ones."""
+        with context_switch(self):
+            self._handle_events(self.event_queue.drain(False, self.batch_size))
+
+    def start(self, daemon=True, executor=None):
+        """
+        Starts handling events.
+
+        Daemon contexts are run on the given executor, or on the default
+        executor if one is set. Other contexts always get their own thread, as
+        they have to keep the process alive.
+        """
         self.daemon = daemon
+        executor = executor or default_executor
+        if executor is not None and daemon:
+            executor.attach(self)
+            return
+
+        thread = threading.Thread(target=self.run)
         thread.daemon = self.daemon
         thread.start()
 
     def stop(self):
-        global_channel.unsubscribe(self._pubsub_receiver, 'event')
+        global_channel.unsubscribe(self._pubsub_receiver, 'event', self.interest)
         if not self.daemon:
-            self.done = True
+            if get_context() is self:
+                # take a final checkpoint in between events
+                if self.checkpointer is not None:
+                    self.checkpointer.save(self)
+                self.done = True
+            else:
+                # the event loop takes the final checkpoint and stops once it
+                # gets to these, after the events queued before them
+                if self.checkpointer is not None:
+                    self._enqueue(queues.Task(self.checkpointer.save, self))
+                self._enqueue(queues.STOP)
         else:
             logger.warning("Can't shutdown daemon context. The context is used in a server.")
 
-    def _handle_event(self):
-        """Handles a single event, or times out after receiving nothing."""
+    def _handle_events(self, events):
+        """Handles a batch of events back to back."""
+        for event in self._dispatch(events):
+            try:
+                # Determine candidate rules and execute matches: only rules
+                # that match the event name and for which all conditions hold
+                for r in self.rules.match(self.scope, event, self._rejected):
+                    self._fire_rule(r, event)
+            except Exception:
+                self._failed(event)
+
+    async def _handle_events_async(self, events):
+        """Handles a batch of events back to back, awaiting async actions."""
+        for event in self._dispatch(events):
+            try:
+                for r in self.rules.match(self.scope, event, self._rejected):
+                    await self._fire_rule_async(r, event)
+            except Exception:
+                self._failed(event)
+
+    def _dispatch(self, events):
+        """
+        Generates the events of a batch that are to be handled.
+
+        This does the bookkeeping shared by the sync and async event loops:
+        control items are dealt with here, and around each generated event
+        the emits are collected and published and the handling time is
+        measured. The batch ends early at STOP, or once an action has stopped
+        the context.
+        """
+        stats = self.metrics
+        token = handling.set(True)
         try:
-            # wait until we have an upcoming event
-            # (but don't wait too long -- self.done could have been set to
-            #  true while we were waiting for an event)
-            event = self.event_queue.get(timeout=1.0)
+            for event in events:
+                if event is queues.STOP:
+                    self.done = True
+                    break
+                if event.__class__ is not Event:
+                    try:
+                        event.run()
+                    except Exception:
+                        self._failed(event)
+                else:
+                    start = time.perf_counter() if stats is not None else 0
+                    self.emits = []
+                    try:
+                        yield event
+                    finally:
+                        self._publish_emits()
+                    if stats is not None:
+                        stats.observe(time.perf_counter() - start)
+
+                # an action may have stopped the context
+                if self.done:
+                    break
+        finally:
+            handling.reset(token)
+
+    def _failed(self, item):
+        # a failing action must not take the rest of the batch along
+        logger.exception("Uncaught exception in context '{}' for {}".format(self.name, item))
+
+    def _publish_emits(self):
+        """
+        Publishes the emits made while handling an event.
 
-            self._trace("Working on event: {}".format(event))
+        A single emit is published as 'emit'. Multiple emits are published
+        together as a list on 'emit-batch', so listeners can deliver them at
+        once.
+        """
+        emits, self.emits = self.emits, None
+        if len(emits) == 1:
+            self.channel.publish('emit', emits[0])
+        elif emits:
+            self.channel.publish('emit-batch', emits)
 
-            # Determine candidate rules and execute matches:
-            # 1) Only rules that match the event name as one of the events
-            candidates = [r for r in self.rules.rules if event.name in r.events]
+    def _fire_rule(self, r, event):
+        """
+        Invokes the action of a matching rule.
 
-            # 2) Only rules for which all conditions hold
-            for r in candidates:
-                if not [c(self.scope, event) for c in r.conditions].count(False):
-                    self._trace("Rule: {}".format(util.describe_function(r)))
-                    result = r(self.scope, event)
+        Async actions run to completion here, on the event loop this thread
+        keeps for them (see _run_coroutine). Under the asyncio engine they are
+        awaited by _fire_rule_async instead, which lets other contexts run in
+        the meantime.
+        """
+        timed = tracing.recorder is not None or metrics.registry is not None
+        start = time.perf_counter() if timed else 0
+        try:
+            result = r(self.scope, event)
+            if inspect.iscoroutine(result):
+                _run_coroutine(result)
+        finally:
+            if timed:
+                self._fired(r, event, time.perf_counter() - start)
+
+    async def _fire_rule_async(self, r, event):
+        """Invokes the action of a matching rule, awaiting async actions."""
+        timed = tracing.recorder is not None or metrics.registry is not None
+        start = time.perf_counter() if timed else 0
+        try:
+            result = r(self.scope, event)
+            if inspect.isawaitable(result):
+                await result
+        finally:
+            if timed:
+                self._fired(r, event, time.perf_counter() - start)
 
-        except queue.Empty:
-            # Timeout on waiting
-            pass
+    def _fired(self, r, event, duration):
+        """Reports the firing of a rule to the trace recorder and metrics."""
+        recorder = tracing.recorder
+        if recorder is not None:
+            recorder.fired(self, event, r, duration)
+        registry = metrics.registry
+        if registry is not None:
+            registry.fired(r, duration)
+
+
+# event loops kept per thread to run async actions outside of the engine
+_loops = threading.local()
+
+
+def _run_coroutine(coroutine):
+    """
+    Runs a coroutine to completion on the calling thread.
+
+    This is how async actions run in contexts that are not run by the asyncio
+    engine. Each thread keeps its own event loop for this, as setting up a
+    loop per action (like asyncio.run does) is slow. Tasks that an action
+    leaves behind only make progress while a later action runs on the same
+    thread; use the asyncio engine for contexts with many async actions.
+    """
+    loop = getattr(_loops, 'loop', None)
+    if loop is None:
+        loop = _loops.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
 
 
 @contextmanager
@@ -225,7 +595,7 @@ def context_switch(context):
     different from the eca Context.)
 
     This function can be written without any regard for locking as the
-    thread_local object will take care of that. Since everything here is done
+    current_context variable will take care of that. Since everything here is done
     in the same thread, this effectively allows nesting of context switches.
     """
     # activate new context and store old
@@ -243,17 +613,17 @@ def context_activate(context):
     disable the context.
     """
     # stash old context
-    old_context = getattr(thread_local, 'context', None)
+    old_context = current_context.get()
 
     # switch to new context
-    thread_local.context = context
+    current_context.set(context)
 
     return old_context
 
 
 def get_context():
     """Returns the current context."""
-    return getattr(thread_local, 'context', None)
+    return current_context.get()
 
 
 def auxiliary(name):
@@ -282,30 +652,39 @@ def shutdown():
         raise NotImplementedError("Can not invoke shutdown without a current context.")
     context.stop()
 
-def fire(eventname, data=None, delay=None):
+def fire(eventname, data=None, delay=None, priority=0):
     """
     Fires an event.
 
-    This is the fire-and-forget method to create new events.
+    This is the fire-and-forget method to create new events. Events with a
+    higher priority are handled before pending events with a lower priority.
     """
-    e = Event(eventname, data)
+    e = Event(eventname, data, priority)
     context = get_context()
     if context is None:
         raise NotImplementedError("Can't invoke fire without a current context.")
     context.channel.publish('event', e, delay)
 
 
-def fire_global(eventname, data=None, delay=None):
+def fire_global(eventname, data=None, delay=None, priority=0):
     """
     Fires a global event.
+
+    The event is only delivered to contexts with rules for the event.
     """
-    e = Event(eventname, data)
-    global_channel.publish('event', e, delay)
+    e = Event(eventname, data, priority)
+    global_channel.publish('event', e, delay, eventname)
 
 
 def emit(name, data, id=None):
     """
     Emits an event to whomever is listening (mostly HTTP clients).
+
+    Emits made by actions are delivered once the event that triggered them has
+    been handled, batched together if there are several.
+
+    Event streams (eca.http.EventStream) ignore the given id, as they number
+    emits themselves so reconnecting clients can catch up.
     """
     e = Event(name, {
         'json': json.dumps(data),
@@ -315,12 +694,43 @@ def emit(name, data, id=None):
     context = get_context()
     if context is None:
         raise NotImplementedError("Can't invoke emit without a current context.")
-    context.channel.publish('emit', e)
+
+    # emits made by actions are published after the event has been handled
+    emits = getattr(context, 'emits', None)
+    if emits is not None:
+        emits.append(e)
+    else:
+        context.channel.publish('emit', e)
 
 
-def spawn_context(init_data=None, name='<unnamed context>', rules=rules, daemon=False):
+def spawn_context(init_data=None, name='<unnamed context>', rules=rules, daemon=False, executor=None, capacity=None, overflow=queues.BLOCK):
     """
     Spawns a new context and starts it.
+
+    Daemon contexts are run on the given executor, or on the default executor
+    if none is given. The capacity and overflow policy configure the
+    context's event queue.
+    """
+    context = Context(init_data, name, rules, capacity, overflow)
+    context.start(daemon, executor)
+
+
+def use_global_channel(channel):
+    """
+    Replaces the global event channel.
+
+    This must be done before any context is created, as contexts subscribe to
+    the global channel on creation.
+    """
+    global global_channel
+    global_channel = channel
+
+
+def use_executor(executor):
+    """
+    Sets the default executor for daemon contexts.
+
+    Passing None restores the default of one thread per context.
     """
-    context = Context(init_data, name, rules)
-    context.start(daemon)
+    global default_executor
+    default_executor = executor
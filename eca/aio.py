@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import threading
+
+from . import context_switch
+from . import metrics
+from . import queues
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncEngine:
+    """
+    Runs contexts as asyncio tasks on a single event loop.
+
+    Each attached context becomes a task that waits for events and handles
+    them one at a time. Actions defined with 'async def' are awaited, so an
+    action doing I/O only blocks its own context. Delayed events of attached
+    contexts are scheduled with loop.call_later.
+
+    Events can be received from any thread; the engine wakes up the context's
+    task through the loop.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.new_event_loop()
+        self.wakers = {}
+
+        # delays waiting on the loop, only touched in the loop
+        self.pending = 0
+        metrics.schedulers.add(self)
+
+    def start(self):
+        """Runs the event loop in a background thread."""
+        def run_forever():
+            queues.never_block()
+            self.loop.run_forever()
+
+        thread = threading.Thread(target=run_forever, name='eca-asyncio')
+        thread.daemon = True
+        thread.start()
+
+    def run(self, context):
+        """Runs the event loop in this thread until the context is done."""
+        queues.never_block()
+        context.daemon = False
+        self.attach(context)
+        task = self.wakers[context].task
+        self.loop.run_until_complete(task)
+
+        # like daemon threads, remaining contexts end with the main context
+        pending = [waker.task for waker in self.wakers.values()]
+        for t in pending:
+            t.cancel()
+        if pending:
+            self.loop.run_until_complete(asyncio.wait(pending))
+
+    def attach(self, context):
+        """Runs the context on this engine."""
+        context.executor = self
+        context.channel.scheduler = self.schedule
+        waker = self.wakers[context] = _Waker()
+
+        def spawn():
+            waker.task = self.loop.create_task(self._run(context, waker))
+
+        if self._in_loop() or not self.loop.is_running():
+            spawn()
+        else:
+            self.loop.call_soon_threadsafe(spawn)
+        self.notify(context)
+
+    def notify(self, context):
+        """Notifies the engine that the context has pending events."""
+        waker = self.wakers.get(context)
+        if waker is None or waker.requested:
+            return
+        waker.requested = True
+        self.loop.call_soon_threadsafe(waker.wake)
+
+    def schedule(self, delay, callback, *args):
+        """Schedules a callback on the event loop."""
+        if self._in_loop():
+            self._later(delay, callback, args)
+        else:
+            self.loop.call_soon_threadsafe(self._later, delay, callback, args)
+
+    def _later(self, delay, callback, args):
+        self.pending += 1
+        self.loop.call_later(delay, self._due, callback, args)
+
+    def _due(self, callback, args):
+        self.pending -= 1
+        callback(*args)
+
+    def _in_loop(self):
+        """Determines if the caller runs in the engine's event loop."""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def _run(self, context, waker):
+        """Task main loop for a single context."""
+        # created in the loop, as before Python 3.10 an Event binds to the
+        # event loop of the thread that creates it
+        waker.event = asyncio.Event()
+        if waker.requested:
+            # woken before the task started
+            waker.event.set()
+
+        with context_switch(context):
+            while not context.done:
+                if len(context.event_queue):
+                    # more than one batch was pending, let other tasks run
+                    await asyncio.sleep(0)
+                else:
+                    await waker.event.wait()
+                waker.event.clear()
+                waker.requested = False
+                try:
+                    events = context.event_queue.drain(False, context.batch_size)
+                    await context._handle_events_async(events)
+                except Exception:
+                    logger.exception("Uncaught exception in context '{}'".format(context.name))
+        del self.wakers[context]
+
+
+class _Waker:
+    """Bookkeeping to wake up the task of a single context."""
+    def __init__(self):
+        self.requested = False
+        self.event = None
+        self.task = None
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
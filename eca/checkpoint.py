@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+
+from . import queues
+from . import timers
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpointer:
+    """
+    Incremental checkpoints of context scopes in an append-only file.
+
+    Every interval seconds, each attached context writes the keys of its
+    scope that have changed since the last checkpoint (or that have been
+    removed). Changes are detected by comparing a digest of the pickled value,
+    so changes to mutable values (like a dictionary of word counts) are noticed
+    as well. Checkpoints are taken by the context itself, in between events,
+    so they always see a consistent scope.
+
+    The file is a sequence of pickled (context name, key, value) records,
+    where the value is the pickled scope value or None for a removed key.
+    When the file has grown to more than twice the size of the live data, it
+    is compacted by rewriting only the live records.
+
+    Scope values that can not be pickled are not checkpointed.
+    """
+
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+
+        # restorable values and digests of written values per context name
+        self.saved = {}
+        self.digests = {}
+        self.live = {}
+
+        corrupt = self._load()
+        self.file = open(self.path, 'ab')
+        if corrupt:
+            self._compact()
+
+    def _load(self):
+        """Reads an existing checkpoint file. Returns True if it is corrupt."""
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    name, key, payload = pickle.load(f)
+                except EOFError:
+                    return False
+                except Exception:
+                    logger.warning("Checkpoint '{}' is truncated; compacting".format(self.path))
+                    return True
+
+                values = self.saved.setdefault(name, {})
+                if payload is None:
+                    values.pop(key, None)
+                    self.digests.get(name, {}).pop(key, None)
+                    self.live.pop((name, key), None)
+                else:
+                    values[key] = payload
+                    self.digests.setdefault(name, {})[key] = _digest(payload)
+                    self.live[(name, key)] = len(payload)
+
+    def attach(self, context):
+        """
+        Restores the scope of the context and starts taking checkpoints.
+
+        Returns True if the scope was restored from a checkpoint.
+        """
+        restored = False
+        with self.lock:
+            values = self.saved.pop(context.name, None)
+        if values:
+            for key, payload in values.items():
+                try:
+                    context.scope[key] = pickle.loads(payload)
+                except Exception as e:
+                    logger.warning("Can't restore '{}' of context '{}' (reason: {})".format(key, context.name, e))
+            restored = True
+
+        timers.schedule(self.interval, self._request, context)
+        return restored
+
+    def _request(self, context):
+        """Asks the context to take a checkpoint in between events."""
+        if context.done:
+            return
+        context._enqueue(queues.Task(self.save, context))
+        timers.schedule(self.interval, self._request, context)
+
+    def save(self, context):
+        """
+        Writes the changed keys of the context's scope.
+
+        This must be called by the thread handling the context's events.
+        """
+        records = []
+        digests = self.digests.setdefault(context.name, {})
+
+        for key, value in list(context.scope.items()):
+            try:
+                payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                continue
+            digest = _digest(payload)
+            if digests.get(key) != digest:
+                digests[key] = digest
+                records.append((context.name, key, payload))
+
+        for key in set(digests) - set(context.scope):
+            del digests[key]
+            records.append((context.name, key, None))
+
+        if not records:
+            return
+
+        with self.lock:
+            for record in records:
+                pickle.dump(record, self.file, pickle.HIGHEST_PROTOCOL)
+                name, key, payload = record
+                if payload is None:
+                    self.live.pop((name, key), None)
+                else:
+                    self.live[(name, key)] = len(payload)
+            self.file.flush()
+
+            # compact if the file holds much more than the live data
+            if self.file.tell() > 2 * sum(self.live.values()) + 65536:
+                self._compact()
+
+    def _compact(self):
+        """Rewrites the checkpoint file with only the live records."""
+        values = {}
+        self.file.close()
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    name, key, payload = pickle.load(f)
+                except Exception:
+                    break
+                if payload is None:
+                    values.pop((name, key), None)
+                else:
+                    values[(name, key)] = payload
+
+        temporary = self.path + '.compact'
+        with open(temporary, 'wb') as f:
+            for (name, key), payload in values.items():
+                pickle.dump((name, key, payload), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+        self.live = {k: len(p) for k, p in values.items()}
+        self.file = open(self.path, 'ab')
+
+
+def _digest(payload):
+    return hashlib.blake2b(payload, digest_size=16).digest()
@@ -0,0 +1,252 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import zlib
+
+from . import Context, use_executor, use_global_channel
+from . import pubsub
+from . import queues
+from . import util
+from .checkpoint import Checkpointer
+from .executor import ContextExecutor
+from .journal import Journal
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterChannel(pubsub.PubSubChannel):
+    """
+    Global event channel that spans all processes of a cluster.
+
+    Publishing hands the event to the forward callable, which routes it to
+    all processes. Each process delivers routed events to its own subscribers
+    with deliver(). Delayed publishes are delayed in the publishing process.
+    """
+
+    def __init__(self, forward):
+        super().__init__()
+        self.forward = forward
+
+    def publish(self, event='message', data=None, delay=None, key=None):
+        if delay is None:
+            self.forward(event, data, key)
+        else:
+            self.scheduler(delay, self.publish, event, data, None, key)
+
+    def deliver(self, event, data, key=None):
+        """Publishes a routed event to the subscribers in this process."""
+        super().publish(event, data, None, key)
+
+
+class RemoteContext:
+    """
+    Stand-in for a context that runs in a worker process of a cluster.
+
+    Events received by this context are sent to the worker process, so
+    fire() works as usual with a remote context as current context. Emits of
+    the worker context are published on the local channel, so HTTP handlers
+    can subscribe to them as if the context were local.
+    """
+
+    def __init__(self, cluster, worker, id, name):
+        self.cluster = cluster
+        self.worker = worker
+        self.id = id
+        self.name = name
+        self.channel = pubsub.PubSubChannel()
+        self.auxiliaries = {}
+        self.stopped = threading.Event()
+
+        # subscribe to own pubsub channel to forward events
+        self.channel.subscribe(self._pubsub_receiver, 'event')
+
+    def _pubsub_receiver(self, name, data):
+        """Pubsub channel connector."""
+        self.receive_event(data)
+
+    def receive_event(self, event, policy=None):
+        """Sends an Event to the worker context."""
+        self.cluster.send(self.worker, ('event', self.id, event, policy))
+
+    def auxiliary(self, name):
+        return self.auxiliaries[name]
+
+    def stop(self):
+        self.cluster.send(self.worker, ('stop', self.id))
+
+    def wait(self):
+        """Waits until the worker context has stopped."""
+        self.stopped.wait()
+
+
+class Cluster:
+    """
+    Runs contexts on a pool of worker processes.
+
+    Every worker process imports the rules module, and runs the contexts that
+    are placed on it. Contexts are placed by a hash of their name. Events
+    fired within a worker stay in that worker, delayed events are scheduled
+    by the worker, global events are routed through this process to all
+    workers and emits are sent back to this process. HTTP handling and server
+    side events stay in this process.
+
+    Contexts spawned by rules inside a worker run in that same worker.
+
+    If a checkpoint or journal path is given, each worker keeps its own file
+    with the worker index appended to the path.
+    """
+
+    def __init__(self, rules_file, processes=None, workers=None, log_level=logging.WARNING, checkpoint=None, interval=5.0,
+                 journal=None):
+        processes = processes or os.cpu_count() or 1
+        mp = multiprocessing.get_context('spawn')
+
+        self.processes = []
+        self.connections = []
+        self.locks = []
+        self.contexts = {}
+        self.ids = itertools.count()
+        self.stopping = False
+        self.global_channel = ClusterChannel(self.broadcast)
+
+        for i in range(processes):
+            parent, child = mp.Pipe()
+            process = mp.Process(target=_worker,
+                                 args=(os.path.abspath(rules_file), child, workers, log_level,
+                                       checkpoint and '{}.{}'.format(checkpoint, i), interval,
+                                       journal and '{}.{}'.format(journal, i)),
+                                 name='eca-process-{}'.format(i))
+            process.daemon = True
+            process.start()
+            child.close()
+
+            self.processes.append(process)
+            self.connections.append(parent)
+            self.locks.append(threading.Lock())
+
+            thread = threading.Thread(target=self._receive, args=(i,), name='eca-cluster-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def place(self, name):
+        """Determines the worker process for a context name."""
+        return zlib.crc32(name.encode('utf-8')) % len(self.connections)
+
+    def spawn_context(self, init_data=None, name='<unnamed context>', daemon=True, capacity=None, overflow=queues.BLOCK):
+        """Spawns a new context on a worker and returns its stand-in."""
+        worker = self.place(name)
+        context = RemoteContext(self, worker, next(self.ids), name)
+        self.contexts[context.id] = context
+        self.send(worker, ('spawn', context.id, name, init_data, daemon, capacity, overflow))
+        return context
+
+    def send(self, worker, message):
+        """Sends a message to a worker process."""
+        with self.locks[worker]:
+            self.connections[worker].send(message)
+
+    def broadcast(self, event, data, key):
+        """Routes a global event to all worker processes."""
+        for worker in range(len(self.connections)):
+            self.send(worker, ('global', event, data, key))
+
+    def stop(self):
+        """Stops all worker processes and waits for them to finish."""
+        self.stopping = True
+        for worker in range(len(self.connections)):
+            self.send(worker, ('exit',))
+        for process in self.processes:
+            process.join(timeout=5)
+
+    def _receive(self, worker):
+        """Handles the messages from a single worker process."""
+        connection = self.connections[worker]
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                if not self.stopping:
+                    logger.error("Worker process {} has terminated".format(worker))
+                return
+
+            kind = message[0]
+            if kind == 'emit':
+                context = self.contexts.get(message[1])
+                if context is not None:
+                    context.channel.publish(message[2], message[3])
+            elif kind == 'global':
+                self.broadcast(*message[1:])
+            elif kind == 'stopped':
+                context = self.contexts.pop(message[1], None)
+                if context is not None:
+                    context.stopped.set()
+
+
+def _worker(rules_file, connection, workers, log_level, checkpoint, interval, journal):
+    """Worker process main loop."""
+    logging.basicConfig(level=log_level)
+
+    checkpointer = Checkpointer(checkpoint, interval) if checkpoint else None
+    journal = Journal(journal) if journal else None
+
+    lock = threading.Lock()
+    def send(message):
+        with lock:
+            connection.send(message)
+
+    # route global events through the front process
+    channel = ClusterChannel(lambda event, data, key: send(('global', event, data, key)))
+    use_global_channel(channel)
+
+    if workers:
+        use_executor(ContextExecutor(workers))
+
+    util.load_module(rules_file)
+
+    # one full context must not stall the messages for all others, nor wait
+    # on a front process that is itself waiting to write to this worker
+    queues.never_block()
+
+    contexts = {}
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+
+        kind = message[0]
+        if kind == 'spawn':
+            id, name, init_data, daemon, capacity, overflow = message[1:]
+            context = Context(init_data, name, capacity=capacity, overflow=overflow, checkpointer=checkpointer,
+                              journal=journal)
+            contexts[id] = context
+
+            # send emits to the front process
+            def emitter(topic, data, id=id):
+                send(('emit', id, topic, data))
+            context.channel.subscribe(emitter, 'emit')
+            context.channel.subscribe(emitter, 'emit-batch')
+
+            if daemon:
+                context.start()
+            else:
+                def run(context=context, id=id):
+                    context.run()
+                    send(('stopped', id))
+                context.daemon = False
+                thread = threading.Thread(target=run)
+                thread.daemon = True
+                thread.start()
+        elif kind == 'event':
+            contexts[message[1]].receive_event(message[2], message[3])
+        elif kind == 'global':
+            channel.deliver(*message[1:])
+        elif kind == 'stop':
+            contexts[message[1]].stop()
+        elif kind == 'exit':
+            break
+
+    if journal is not None:
+        journal.close()
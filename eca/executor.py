@@ -0,0 +1,65 @@
+import logging
+import os
+import queue
+import threading
+
+from . import queues
+
+logger = logging.getLogger(__name__)
+
+
+class ContextExecutor:
+    """
+    Runs many contexts on a fixed pool of worker threads.
+
+    Instead of giving each context its own thread, a context is scheduled as
+    a unit of work whenever its event queue is non-empty. A worker takes the
+    context, handles the pending events with the context switched in, and
+    reschedules the context if more events have arrived in the meantime.
+
+    A context is never scheduled more than once at the same time, so each
+    context still handles only one event at a time.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.lock = threading.Lock()
+        self.scheduled = set()
+        self.ready = queue.SimpleQueue()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, name='eca-worker-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def attach(self, context):
+        """Runs the context on this executor."""
+        context.executor = self
+        self.notify(context)
+
+    def notify(self, context):
+        """Notifies the executor that the context has pending events."""
+        with self.lock:
+            if context in self.scheduled:
+                return
+            self.scheduled.add(context)
+        self.ready.put(context)
+
+    def run(self):
+        """Worker thread main loop."""
+        queues.never_block()
+        while True:
+            context = self.ready.get()
+            try:
+                context.run_pending()
+            except Exception:
+                logger.exception("Uncaught exception in context '{}'".format(context.name))
+
+            # reschedule if events arrived while the context was running
+            with self.lock:
+                self.scheduled.discard(context)
+                again = len(context.event_queue) > 0 and not context.done
+                if again:
+                    self.scheduled.add(context)
+            if again:
+                self.ready.put(context)
@@ -0,0 +1,105 @@
+import collections.abc
+
+# value of fields of event data that is not a mapping
+MISSING = object()
+
+
+def value(event, name):
+    """
+    Returns the value of a field of the event data.
+
+    Like event.get(), this returns None for absent fields. If the event data
+    is not a mapping, MISSING is returned.
+    """
+    data = event.data
+    if isinstance(data, collections.abc.Mapping):
+        return data.get(name)
+    return MISSING
+
+
+class FieldTest:
+    """
+    Declarative condition on a single field of the event data.
+
+    Field tests are callable like any other condition, but the rules engine
+    can look inside them. Tests that pass for a finite set of values expose
+    that set as values, so rules can be indexed on the field; other tests are
+    evaluated before opaque conditions, as they are cheap.
+    """
+    values = None
+
+    def __init__(self, field):
+        self.field = field
+
+    def __call__(self, scope, event):
+        return self.test(value(event, self.field))
+
+    def test(self, value):
+        raise NotImplementedError()
+
+
+class Equals(FieldTest):
+    def __init__(self, field, value):
+        super().__init__(field)
+        self.value = value
+        try:
+            self.values = frozenset([value])
+        except TypeError:
+            pass
+
+    def test(self, value):
+        return value is not MISSING and value == self.value
+
+    def __repr__(self):
+        return "field '{}' == {!r}".format(self.field, self.value)
+
+
+class In(FieldTest):
+    def __init__(self, field, values):
+        super().__init__(field)
+        self.values = frozenset(values)
+
+    def test(self, value):
+        try:
+            return value in self.values
+        except TypeError:
+            return False
+
+    def __repr__(self):
+        return "field '{}' in {!r}".format(self.field, set(self.values))
+
+
+class Range(FieldTest):
+    def __init__(self, field, low=None, high=None):
+        super().__init__(field)
+        self.low = low
+        self.high = high
+
+    def test(self, value):
+        if value is MISSING:
+            return False
+        try:
+            return (self.low is None or self.low <= value) and (self.high is None or value <= self.high)
+        except TypeError:
+            return False
+
+    def __repr__(self):
+        return "field '{}' in [{!r}, {!r}]".format(self.field, self.low, self.high)
+
+
+def field_equals(name, value):
+    """Condition that holds if the field of the event data equals value."""
+    return Equals(name, value)
+
+
+def field_in(name, values):
+    """Condition that holds if the field of the event data is one of values."""
+    return In(name, values)
+
+
+def field_range(name, low=None, high=None):
+    """
+    Condition that holds if the field of the event data lies between low and
+    high, inclusive. Either bound can be left out.
+    """
+    return Range(name, low, high)
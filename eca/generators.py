@@ -2,8 +2,9 @@ import threading
 import time
 from datetime import datetime
 import json
-from . import fire, get_context, context_switch, register_auxiliary, auxiliary
+from . import Event, get_context, context_switch, register_auxiliary, auxiliary
 from . import arff
+from . import queues
 import logging
 import sys
 
@@ -14,10 +15,15 @@ class EventGenerator:
     """
     An event generator uses a generation function to generate events from
     any external source.
+
+    Generated events are delivered with the given overflow policy. The
+    default BLOCK policy makes the generator wait while the context's queue
+    is full, which acts as natural backpressure.
     """
-    def __init__(self, context, generator, event_name='tweet', **kwargs):
+    def __init__(self, context, generator, event_name='tweet', policy=queues.BLOCK, **kwargs):
         self.context = context
         self.event_name = event_name
+        self.policy = policy
         self.generator = generator
         self.generator_args = kwargs
         self.stop_flag = threading.Event()
@@ -45,7 +51,7 @@ class EventGenerator:
         logger.debug("Running event generator")
         with context_switch(self.context):
             for event in self.generator(self.stop_flag, **self.generator_args):
-                fire(self.event_name, event)
+                self.context.receive_event(Event(self.event_name, event), self.policy)
 
     
 def offline_tweets(stop, data_file, time_factor=1000, arff_file=None):
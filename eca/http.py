@@ -2,10 +2,14 @@ import http.cookies
 import logging
 import json
 import collections
+import itertools
+import os
+import threading
 from . import httpd
 from . import sse
 from . import fire, get_context
 from . import sessions
+from . import metrics
 
 
 # Logging
@@ -33,10 +37,6 @@ class Cookies(httpd.Filter):
 class HelloWorld(httpd.Handler):
     """The mandatory Hello World example."""
     def handle_GET(self):
-        self.request.send_response(200)
-        self.request.send_header('content-type','text/html; charset=utf-8')
-        self.request.end_headers()
-
         output = "<!DOCTYPE html><html><body><h1>Hello world!</h1><p><i>eca-session:</i> {}</p></body></html>"
 
         try:
@@ -44,8 +44,35 @@ class HelloWorld(httpd.Handler):
             cookie = self.request.cookies['eca-session'].value
         except KeyError:
             cookie = '<i>no cookie</i>';
-        
-        self.request.wfile.write(output.format(cookie).encode('utf-8'))
+
+        output = output.format(cookie).encode('utf-8')
+        self.request.send_response(200)
+        self.request.send_header('content-type','text/html; charset=utf-8')
+        self.request.send_header('content-length', len(output))
+        self.request.end_headers()
+        self.request.wfile.write(output)
+
+
+class Metrics(httpd.Handler):
+    """
+    Exposes the engine metrics in the Prometheus text format.
+
+    Filters are not applied, so scraping does not create sessions.
+    """
+    apply_filters = False
+
+    def handle_GET(self):
+        registry = metrics.registry
+        if registry is None:
+            self.request.send_error(404, "Metrics are not enabled.")
+            return
+
+        output = registry.render().encode('utf-8')
+        self.request.send_response(200)
+        self.request.send_header('content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.request.send_header('content-length', len(output))
+        self.request.end_headers()
+        self.request.wfile.write(output)
 
 
 def Redirect(realpath):
@@ -69,20 +96,25 @@ def Redirect(realpath):
     
                 location = "http://{}{}".format(host, realpath)
 
+            output = "<!DOCTYPE html><html><body><p>Redirect to <a href='{0}'>{0}</a></p></body></html>"
+            output = output.format(location).encode('utf-8')
             self.request.send_response(302)
             self.request.send_header('content-type','text/html; charset=utf-8')
+            self.request.send_header('content-length', len(output))
             self.request.send_header('location',location)
             self.request.end_headers()
-            output = "<!DOCTYPE html><html><body><p>Redirect to <a href='{0}'>{0}</a></p></body></html>"
-            self.request.wfile.write(output.format(location).encode('utf-8'))
+            self.request.wfile.write(output)
 
     return RedirectHandler
 
 
-def GenerateEvent(name):
+def GenerateEvent(name, priority=1):
     """
     This function returns a handler class that creates the named event based
     on the posted JSON data.
+
+    The events are fired with the given priority, which by default lets them
+    overtake bulk events.
     """
     class EventGenerationHandler(httpd.Handler):
         def handle_POST(self):
@@ -107,7 +139,7 @@ def GenerateEvent(name):
                 return
 
             try:
-                fire(name, structured)
+                fire(name, structured, priority=priority)
             except NotImplementedError:
                 logger.warn("Event generated by HTTP request without active session. Do you have a SessionManager configured?")
                 self.request.send_error(500, "No current context available.")
@@ -121,15 +153,117 @@ def GenerateEvent(name):
     return EventGenerationHandler
 
 
+class EmitBuffer:
+    """
+    Numbers the emits of a context and keeps the most recent ones.
+
+    Every emit gets the next id of a monotonic sequence, and is kept in a ring
+    buffer of the given size. Event streams attach to the buffer to receive
+    emits; a reconnecting stream first receives the emits it has missed since
+    the last id it has seen. If some of those have already left the buffer,
+    the stream is reset instead, as a partial replay would hide the gap.
+
+    Ids are sent as '<epoch>-<number>', where the epoch is random per buffer.
+    An id from another buffer, such as one from before a server restart, can
+    then not be mistaken for a position in this one.
+    """
+    def __init__(self, context, size=256):
+        self.frames = collections.deque(maxlen=size)
+        self.epoch = os.urandom(4).hex()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.streams = ()
+        context.channel.subscribe(self._emit, 'emit')
+        context.channel.subscribe(self._emit_batch, 'emit-batch')
+
+    def _emit(self, name, event):
+        self._publish((event,))
+
+    def _emit_batch(self, name, events):
+        self._publish(events)
+
+    def _publish(self, events):
+        with self.lock:
+            frames = [(next(self.ids), e.name, e.data.get('json')) for e in events]
+            self.frames.extend(frames)
+            for stream in self.streams:
+                stream.send_frames(frames)
+
+    def attach(self, stream, last_id=None):
+        """Attaches a stream, replaying the frames after last_id first."""
+        with self.lock:
+            if last_id is not None and self.frames:
+                latest = self.frames[-1][0]
+                if last_id < self.frames[0][0] - 1:
+                    stream.send_reset(latest, latest - last_id)
+                else:
+                    missed = [f for f in self.frames if f[0] > last_id]
+                    if missed:
+                        stream.send_frames(missed)
+            self.streams += (stream,)
+
+    def detach(self, stream):
+        with self.lock:
+            self.streams = tuple(s for s in self.streams if s is not stream)
+
+    def format_id(self, number):
+        return '{}-{}'.format(self.epoch, number)
+
+    def parse_id(self, id):
+        """Returns the number of an id of this buffer, or None."""
+        epoch, _, number = (id or '').rpartition('-')
+        if epoch != self.epoch:
+            return None
+        try:
+            return int(number)
+        except ValueError:
+            return None
+
+
+# guards the creation of emit buffers
+_buffers_lock = threading.Lock()
+
+
 class EventStream(sse.ServerSideEvents):
-    def go_subscribe(self):
-        def receiver(name, event):
-            self.send_event(event.data.get('json'), event.name, event.data.get('id'))
+    """
+    Streams the emits of the current context.
+
+    Emits are numbered by the context's EmitBuffer, and the number is sent as
+    the id of each message, so browsers send it back as Last-Event-ID when
+    they reconnect; the emits missed in between are then replayed. A
+    Last-Event-ID of another buffer is ignored. Ids given to emit() are not
+    used. If the missed emits are no longer all buffered, an 'emit-reset'
+    message with the number of missed emits is sent instead, so the client
+    can reload its state (listen for it like for any other event).
+
+    A batch of emits is sent as a single 'emit-batch' message, of which the
+    data is a list of objects with the event name and data of each emit. The
+    last id in the batch is used as the id of the message.
+    """
+    buffer_size = 256
 
-        self.receiver = receiver
+    def go_subscribe(self):
         context = get_context()
-        context.channel.subscribe(self.receiver, 'emit')
+        with _buffers_lock:
+            buffer = context.auxiliaries.get('emit-buffer')
+            if buffer is None:
+                buffer = context.auxiliaries['emit-buffer'] = EmitBuffer(context, self.buffer_size)
+
+        self.buffer = buffer
+        buffer.attach(self, buffer.parse_id(self.last_event_id()))
 
     def go_unsubscribe(self):
-        context = get_context()
-        context.channel.unsubscribe(self.receiver, 'emit')
+        self.buffer.detach(self)
+
+    def send_reset(self, id, missed):
+        """Tells the client that emits up to id were lost."""
+        self.send_event(json.dumps({'missed': missed}), 'emit-reset', self.buffer.format_id(id))
+
+    def send_frames(self, frames):
+        """Sends (id, name, json) frames, batching several in one message."""
+        if len(frames) == 1:
+            id, name, data = frames[0]
+            self.send_event(data, name, self.buffer.format_id(id))
+        else:
+            parts = ['{{"event":{},"data":{}}}'.format(json.dumps(name), data) for id, name, data in frames]
+            self.send_event('[' + ','.join(parts) + ']', 'emit-batch', self.buffer.format_id(frames[-1][0]))
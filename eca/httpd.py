@@ -2,12 +2,23 @@ import http.server
 import http.cookies
 import socketserver
 import logging
-
+import queue
+import selectors
+import socket
+import threading
+import time
+import functools
+import gzip
+import email.utils
+
+import os
 import os.path
 import posixpath
 import urllib
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+
+from . import context_activate
 
 # Logging
 logger = logging.getLogger(__name__)
@@ -72,10 +83,20 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
       2) Request is passed to the matching handler.
 
     Responsibility for selecting the handler is left to the server class.
+
+    Connections are kept alive between requests (HTTP/1.1), so all handlers
+    must send a Content-Length header or close the connection. Idle
+    connections are closed after timeout seconds.
     """
     error_message_format = DEFAULT_ERROR_MESSAGE
     server_version = 'EcaHTTP/2'
     default_request_version = 'HTTP/1.1'
+    protocol_version = 'HTTP/1.1'
+    timeout = 15
+
+    # headers and body are written separately, which interacts badly with
+    # delayed acknowledgements on kept-alive connections
+    disable_nagle_algorithm = True
 
     def send_header(self, key, value):
         """Buffer headers until they can be sent."""
@@ -95,17 +116,54 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_header(*h)
             self._cached_headers = []
 
+    def handle(self):
+        """
+        Handles requests on the connection.
+
+        With a worker pool, a worker only handles the requests that have
+        already arrived. An idle kept-alive connection is handed back to the
+        server, so it does not tie up the worker until the next request.
+        """
+        if not getattr(self.server, 'pool', None):
+            super().handle()
+            return
+
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self._has_input():
+                self.server.keep(self.request, self.client_address)
+                return
+            self.handle_one_request()
+
+    def _has_input(self):
+        """Checks without blocking whether the next request has arrived."""
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
     def dispatch(self):
         """Dispatch incoming requests."""
+        # worker threads serve many clients, so do not let the context
+        # activated for the previous request leak into this one
+        context_activate(None)
+
         self.handler = None
         self.response_sent = False
+        self._cached_headers = []
 
         # the method we will be looking for
         # (uses HTTP method name to build Python method name)
         method_name = "handle_{}".format(self.command)
 
-        # let server determine specialised handler factory, and call it
-        handler_factory = self.server.get_handler(self.command, self.path)
+        # let server determine specialised handler factory and filters
+        # (by path alone, so query strings do not take up cache entries)
+        path = self.path.split('?', 1)[0].split('#', 1)[0]
+        handler_factory, filters = self.server.resolve(self.command, path)
         if not handler_factory:
             self.send_error(404)
             return
@@ -118,9 +176,11 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             self.send_error(501, "Unsupported method ({})".format(self.command))
             return
 
-        # apply filters to request
+        # apply filters to request, unless the handler opts out
         # note: filters are applied in order of registration
-        for filter_factory in self.server.get_filters(self.command, self.path):
+        if not self.handler.apply_filters:
+            filters = []
+        for filter_factory in filters:
             filter = filter_factory(self)
             if not hasattr(filter, method_name):
                 self.send_error(501, "Unsupported method ({})".format(self.command))
@@ -198,38 +258,237 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
 
 HandlerRegistration = namedtuple('HandlerRegistration',['methods','path','handler'])
 
+
+def _compile(registrations):
+    """
+    Compiles registrations into a prefix trie.
+
+    Each node is a dictionary from the next character of the path to the child
+    node. The registrations for the path that ends at a node are stored as
+    (index, registration) pairs under the None key, where index is the order
+    of registration.
+    """
+    root = {}
+    for index, registration in enumerate(registrations):
+        node = root
+        for char in registration.path:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append((index, registration))
+    return root
+
+
+def _prefixes(trie, method, path):
+    """
+    Generates the (index, registration) pairs of a trie for all prefixes of
+    path that accept the method, shortest prefix first.
+    """
+    node = trie
+    for char in path:
+        for index, registration in node.get(None, ()):
+            if not registration.methods or method in registration.methods:
+                yield index, registration
+        node = node.get(char)
+        if node is None:
+            return
+    for index, registration in node.get(None, ()):
+        if not registration.methods or method in registration.methods:
+            yield index, registration
+
+
 class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     """
     HTTP Server with path/method registration functionality to allow simple
     configuration of served content.
+
+    By default, each connection is handled by a new thread. If a number of
+    workers is given, connections are handled by a fixed pool of worker
+    threads instead. Accepted connections then wait in a queue of at most
+    backlog connections, and once that is full, further connections wait in
+    the listen backlog of the socket (which is also set to backlog). This
+    bounds the number of threads under load spikes. Kept-alive connections
+    that are idle between requests are watched by a single thread, and only
+    handed to a worker once their next request arrives.
+
+    Routes and filters are compiled into prefix tries, so finding them takes
+    time proportional to the length of the path rather than the number of
+    registrations. The handler and filters resolved for each method and path
+    are cached in an LRU cache of cache_size entries.
     """
-    def __init__(self, server_address, RequestHandlerClass=HTTPRequestHandler):
+    request_queue_size = 128
+    cache_size = 1024
+    def __init__(self, server_address, RequestHandlerClass=HTTPRequestHandler, workers=None, backlog=None):
         self.handlers = []
         self.filters = []
+        self._compile()
+
+        # request sockets taken over by other parts of the server
+        self.detached = set()
+
+        if backlog is not None:
+            self.request_queue_size = backlog
+        self.pool = []
         super().__init__(server_address, RequestHandlerClass)
 
+        # start the worker pool if requested
+        if workers:
+            self.pending = queue.Queue(self.request_queue_size)
+            for i in range(workers):
+                thread = threading.Thread(target=self._work, name='eca-http-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self.pool.append(thread)
+
+            # idle kept-alive connections: those handed back by their handler
+            # and those parked until they become readable, with deadline
+            self.kept = {}
+            self.parked = OrderedDict()
+            self.parking = []
+            self.lock = threading.Lock()
+            self.selector = selectors.DefaultSelector()
+            self.waker, self.wakee = socket.socketpair()
+            self.waker.setblocking(False)
+            self.wakee.setblocking(False)
+            self.selector.register(self.wakee, selectors.EVENT_READ)
+            self.watching = True
+            thread = threading.Thread(target=self._watch, name='eca-http-idle')
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        if not self.pool:
+            super().process_request(request, client_address)
+        else:
+            self.pending.put((request, client_address))
+
+    def _work(self):
+        """Worker thread main loop."""
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.kept.pop(request, None)
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def keep(self, request, client_address):
+        """
+        Keeps an idle connection open when its request handler is done.
+
+        The connection is handed to a worker again once the next request
+        arrives, or closed if that takes longer than the handler's timeout.
+        """
+        self.kept[request] = client_address
+
+    def _park(self, request, client_address):
+        with self.lock:
+            self.parking.append((request, client_address))
+        self._wake()
+
+    def _wake(self):
+        """Wakes up the idle connection thread."""
+        try:
+            self.waker.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def _watch(self):
+        """Idle connection thread main loop."""
+        timeout = self.RequestHandlerClass.timeout
+        while self.watching:
+            # wait no longer than until the first parked connection expires
+            wait = None
+            if self.parked:
+                deadline = next(iter(self.parked.values()))[1]
+                wait = max(0, deadline - time.monotonic())
+
+            for key, mask in self.selector.select(wait):
+                if key.data is None:
+                    try:
+                        while self.wakee.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                request = key.fileobj
+                self.selector.unregister(request)
+                client_address, deadline = self.parked.pop(request)
+                self.pending.put((request, client_address))
+
+            with self.lock:
+                parking, self.parking = self.parking, []
+            for request, client_address in parking:
+                deadline = time.monotonic() + timeout if timeout is not None else float('inf')
+                self.parked[request] = (client_address, deadline)
+                self.selector.register(request, selectors.EVENT_READ, request)
+
+            now = time.monotonic()
+            while self.parked:
+                request, (client_address, deadline) = next(iter(self.parked.items()))
+                if deadline > now:
+                    break
+                del self.parked[request]
+                self.selector.unregister(request)
+                super().shutdown_request(request)
+
+        for request in self.parked:
+            super().shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for thread in self.pool:
+            self.pending.put(None)
+        if self.pool:
+            self.watching = False
+            self._wake()
+
+    def detach(self, request):
+        """
+        Detaches a request socket from the server.
+
+        The server will not close a detached socket when the request handler
+        is done, so the connection can be kept open by whoever took it over.
+        """
+        self.detached.add(request)
+
+    def shutdown_request(self, request):
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        if self.pool and request in self.kept:
+            self._park(request, self.kept.pop(request))
+            return
+        super().shutdown_request(request)
+
+    def _compile(self):
+        """Compiles the registrations, and clears the resolve cache."""
+        self.handler_trie = _compile(self.handlers)
+        self.filter_trie = _compile(self.filters)
+        self.resolve = functools.lru_cache(maxsize=self.cache_size)(self._resolve)
+
     def get_handler(self, method, path):
         """Selects the best matching handler."""
-        # Select handlers for the given method, that match any path or a prefix of the given path
-        matches = [m
-                   for m
-                   in self.handlers
-                   if (not m.methods or method in m.methods) and path.startswith(m.path)]
-
-        # if there are matches, we select the one with the longest matching prefix
-        if matches:
-            best = max(matches, key=lambda e: len(e.path))
-            return best.handler
-        else:
-            return None
+        # select the handler with the longest matching prefix; of handlers
+        # for the same prefix the first registered one wins
+        best = None
+        for index, registration in _prefixes(self.handler_trie, method, path):
+            if best is None or len(registration.path) > len(best.path):
+                best = registration
+        return best.handler if best is not None else None
 
     def get_filters(self, method, path):
         """Selects all applicable filters."""
-        # Select all filters that the given method, that match any path or a suffix of the given path
-        return [f.handler
-                for f
-                in self.filters
-                if (not f.methods or method in f.methods) and path.startswith(f.path)]
+        # select all filters for a prefix of the path in order of registration
+        return [registration.handler
+                for index, registration
+                in sorted(_prefixes(self.filter_trie, method, path), key=lambda e: e[0])]
+
+    def _resolve(self, method, path):
+        return self.get_handler(method, path), self.get_filters(method, path)
 
     def _log_registration(self, kind, registration):
         message_format = "Adding HTTP request {} {} for ({} {})"
@@ -250,6 +509,7 @@ class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
         reg = HandlerRegistration(methods, path, handler_factory)
         self._log_registration('handler', reg)
         self.handlers.append(reg)
+        self._compile()
 
     def add_content(self, path, local_path, methods=['GET','HEAD']):
         """
@@ -277,6 +537,7 @@ class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
         reg = HandlerRegistration(methods, path, filter_factory)
         self._log_registration('filter', reg)
         self.filters.append(reg)
+        self._compile()
 
     def serve_forever(self):
         logger.info("Server is running...")
@@ -286,7 +547,13 @@ class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
 class Handler:
     """
     Handler base class.
+
+    Handlers that should not be subjected to the registered filters (e.g.,
+    to not create sessions for monitoring requests) set apply_filters to
+    False.
     """
+    apply_filters = True
+
     def __init__(self, request):
         self.request = request
 
@@ -302,12 +569,193 @@ class Filter(Handler):
         pass
 
 
+CachedFile = namedtuple('CachedFile', ['key', 'body', 'compressed'])
+
+
+class StaticCache:
+    """
+    Serves static files from memory.
+
+    Files of at most max_file bytes are kept in memory, up to max_size bytes
+    in total; the least recently used files are dropped first. Every request
+    checks the modification time and size of the file, so changed files are
+    read again. For compressible content types, a gzip compressed variant is
+    kept as well and sent to clients that accept it. Larger files are sent
+    with sendfile, without copying them through Python.
+
+    Responses carry a strong ETag and Last-Modified header, and conditional
+    requests with If-None-Match or If-Modified-Since are answered with 304 Not
+    Modified when the file has not changed. The gzip compressed variant has
+    an ETag of its own, as it is a different representation.
+    """
+    compressible = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+    def __init__(self, max_size=32 << 20, max_file=1 << 20):
+        self.max_size = max_size
+        self.max_file = max_file
+        self.files = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def serve(self, request, head=False):
+        """Serves the file for the request, or falls back for directories."""
+        path = request.translate_path(request.path)
+        if os.path.isdir(path):
+            # translate_path drops the slash of the mount point itself
+            trailing_slash = request.path.split('?', 1)[0].split('#', 1)[0].endswith('/')
+            for index in ('index.html', 'index.htm'):
+                index = os.path.join(path, index)
+                if trailing_slash and os.path.isfile(index):
+                    path = index
+                    break
+            else:
+                # redirects and directory listings
+                if head:
+                    request.handle_HEAD()
+                else:
+                    request.handle_GET()
+                return
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            request.send_error(404, "File not found")
+            return
+
+        key = (stat.st_mtime_ns, stat.st_size)
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        content_type = request.guess_type(path)
+
+        cached = None
+        if stat.st_size <= self.max_file:
+            cached = self._get(path, key, content_type)
+
+        # select the variant to send, as each variant has its own ETag
+        body = None
+        variants = cached is not None and cached.compressed is not None
+        compress = variants and self._accepts_gzip(request)
+        if cached is not None:
+            body = cached.compressed if compress else cached.body
+        etag = '"{:x}-{:x}{}"'.format(stat.st_mtime_ns, stat.st_size, '-gz' if compress else '')
+
+        if self._not_modified(request, etag, stat.st_mtime):
+            request.send_response(304)
+            if variants:
+                request.send_header('Vary', 'Accept-Encoding')
+            request.send_header('ETag', etag)
+            request.send_header('Last-Modified', last_modified)
+            request.end_headers()
+            return
+
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        if variants:
+            request.send_header('Vary', 'Accept-Encoding')
+        if compress:
+            request.send_header('Content-Encoding', 'gzip')
+        request.send_header('Content-Length', len(body) if body is not None else stat.st_size)
+        request.send_header('ETag', etag)
+        request.send_header('Last-Modified', last_modified)
+        request.end_headers()
+
+        if head:
+            return
+        if body is not None:
+            request.wfile.write(body)
+        else:
+            try:
+                with open(path, 'rb') as f:
+                    request.connection.sendfile(f, 0, stat.st_size)
+            except OSError as e:
+                # the headers are out, so the connection can not be reused
+                logger.warning("Could not send '{}' (reason: {})".format(path, e))
+                request.close_connection = True
+
+    def _not_modified(self, request, etag, mtime):
+        """Evaluates the conditional request headers."""
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError):
+                return False
+            if since is None or since.tzinfo is None:
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def _accepts_gzip(self, request):
+        """Determines if the client accepts gzip content encoding."""
+        for coding in request.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip() not in ('gzip', '*'):
+                continue
+            quality = 1.0
+            key, _, value = params.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+            return quality > 0
+        return False
+
+    def _get(self, path, key, content_type):
+        """Returns the cached file, reading it if it is missing or stale."""
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is not None and cached.key == key:
+                self.files.move_to_end(path)
+                return cached
+
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            return None
+        if len(body) != key[1]:
+            # the file changed while reading it
+            return None
+
+        compressed = None
+        if content_type.startswith(self.compressible):
+            compressed = gzip.compress(body, mtime=0)
+            if len(compressed) >= len(body):
+                compressed = None
+        cached = CachedFile(key, body, compressed)
+
+        with self.lock:
+            previous = self.files.pop(path, None)
+            if previous is not None:
+                self.size -= self._size(previous)
+            self.files[path] = cached
+            self.size += self._size(cached)
+            while self.size > self.max_size and self.files:
+                path, dropped = self.files.popitem(last=False)
+                self.size -= self._size(dropped)
+        return cached
+
+    def _size(self, cached):
+        return len(cached.body) + (len(cached.compressed) if cached.compressed is not None else 0)
+
+
+# The cache shared by all static content handlers
+static_cache = StaticCache()
+
+
 # static content handler defined here, because of intrinsice coupling with
 # request handler.
 def StaticContent(url_path, local_path):
     class StaticContent(Handler):
         """
         Explicit fallback handler.
+
+        Files are served through the shared static content cache.
         """
         def set_paths(self):
             self.request.local_path = local_path
@@ -315,12 +763,11 @@ def StaticContent(url_path, local_path):
             
         def handle_GET(self):
             self.set_paths()
-            self.request.handle_GET()
+            static_cache.serve(self.request)
 
         def handle_HEAD(self):
             self.set_paths()
-            self.request.handle_HEAD()
+            static_cache.serve(self.request, head=True)
 
     # return class so that it can be constructed
     return StaticContent
-
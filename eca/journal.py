@@ -0,0 +1,153 @@
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+
+from . import Event
+from . import timers
+
+logger = logging.getLogger(__name__)
+
+# record header: body length, wall clock time, priority, length of the
+# context name, length of the event name and whether the event was derived
+HEADER = struct.Struct('<IdiHH?')
+
+
+class Journal:
+    """
+    Append-only binary journal of the events accepted by contexts.
+
+    Each record is a fixed size header followed by the UTF-8 encoded context
+    name, the UTF-8 encoded event name and the pickled event data. Records are
+    written to a buffered file which is flushed every interval seconds and
+    on close, so journaling costs no system call per event. The header also
+    records whether the event was derived, that is, created by the rules,
+    windows or patterns of a context rather than coming from outside.
+
+    Events with data that can not be pickled are not journaled.
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        self.records = 0
+        timers.schedule(self.interval, self._flush)
+
+    def record(self, context, event):
+        """Appends an event accepted by the given context."""
+        try:
+            data = pickle.dumps(event.data, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning("Can't journal event {} (reason: {})".format(event, e))
+            return
+
+        context_name = context.name.encode('utf-8')
+        event_name = event.name.encode('utf-8')
+        header = HEADER.pack(len(context_name) + len(event_name) + len(data), time.time(),
+                             event.priority, len(context_name), len(event_name), event.derived)
+
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(header + context_name + event_name + data)
+            self.records += 1
+
+    def flush(self):
+        """Writes all buffered records to the journal file."""
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def _flush(self):
+        if self.file is not None:
+            self.flush()
+            timers.schedule(self.interval, self._flush)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def records(path):
+    """
+    Reads a journal.
+
+    Yields (time, context name, event) for each record. The file is memory
+    mapped, so records are decoded straight from the page cache. A truncated
+    last record, as left by a crash, is ignored.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as journal:
+            offset = 0
+            while offset + HEADER.size <= size:
+                length, timestamp, priority, context_length, event_length, derived = HEADER.unpack_from(journal, offset)
+                start = offset + HEADER.size
+                offset = start + length
+                if offset > size:
+                    break
+
+                names = start + context_length
+                data = names + event_length
+                context_name = journal[start:names].decode('utf-8')
+                event_name = journal[names:data].decode('utf-8')
+                event = Event(event_name, pickle.loads(journal[data:offset]), priority)
+                event.derived = derived
+                yield timestamp, context_name, event
+
+            if offset != size:
+                logger.warning("Journal '{}' ends with a truncated record".format(path))
+
+
+def replay(path, context, rate=None, name=None, exclude=(), stop=None, derived=False):
+    """
+    Feeds the events of a journal into a context.
+
+    Without a rate, events are fed as fast as the context accepts them.
+    Otherwise, the original time between events is divided by rate, so a
+    rate of 1 replays in real time and a rate of 10 replays ten times faster.
+    If a name is given, only the events of contexts with that name are
+    replayed. Events with names in exclude are skipped. Replay ends early if
+    the optional stop event is set.
+
+    Derived events are skipped unless derived is True, as the rules fire them
+    again when they handle the replayed events from outside.
+
+    Returns the number of replayed events.
+    """
+    count = 0
+    first = None
+    start = time.monotonic()
+
+    for timestamp, context_name, event in records(path):
+        if stop is not None and stop.is_set():
+            break
+        if name is not None and context_name != name:
+            continue
+        if event.name in exclude or (event.derived and not derived):
+            continue
+
+        if rate is not None:
+            if first is None:
+                first = timestamp
+            delay = start + (timestamp - first) / rate - time.monotonic()
+            if delay > 0:
+                if stop is not None:
+                    stop.wait(delay)
+                else:
+                    time.sleep(delay)
+
+        context.receive_event(event)
+        count += 1
+
+    return count
@@ -0,0 +1,206 @@
+import bisect
+import os.path
+import sys
+import threading
+import time
+import weakref
+
+from . import timers
+
+
+# Schedulers of delayed events besides the timer wheel (like the asyncio
+# engine), each with a count of pending delays
+schedulers = weakref.WeakSet()
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Generates the Prometheus samples for this histogram."""
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield _sample(name + '_bucket', labels + (('le', le),), cumulative)
+        yield _sample(name + '_sum', labels, self.sum)
+        yield _sample(name + '_count', labels, self.count)
+
+
+class RuleMetrics:
+    """Metrics for a single rule, shared by all contexts."""
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.lock = threading.Lock()
+        self.fires = 0
+        self.rejections = 0
+        self.action_time = Histogram()
+
+    def fired(self, duration):
+        with self.lock:
+            self.fires += 1
+            self.action_time.observe(duration)
+
+    def rejected(self):
+        with self.lock:
+            self.rejections += 1
+
+    def labels(self):
+        name = getattr(self.rule, '__name__', type(self.rule).__name__)
+        code = getattr(self.rule, '__code__', None)
+        if code is None:
+            # like util.describe_function, for callables that are not functions
+            return (('rule', name), ('location', repr(self.rule)))
+        location = "{}:{}".format(os.path.relpath(code.co_filename), code.co_firstlineno)
+        return (('rule', name), ('location', location))
+
+
+class ContextMetrics:
+    """
+    Metrics for a single context.
+
+    These are only updated by the thread handling the context's events, so
+    they need no locking.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.handled = 0
+        self.dispatch_time = Histogram()
+
+    def observe(self, duration):
+        self.handled += 1
+        self.dispatch_time.observe(duration)
+
+
+class Registry:
+    """
+    Registry of all engine metrics.
+
+    Rules and contexts are registered as they are used. Contexts are tracked
+    through weak references, so finished contexts disappear from the metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules = {}
+        self.contexts = weakref.WeakKeyDictionary()
+        self.sse_clients = 0
+
+    def context(self, context):
+        """Registers a context and returns its metrics."""
+        with self.lock:
+            result = self.contexts[context] = ContextMetrics()
+        return result
+
+    def rule(self, rule):
+        """Returns the metrics of a rule."""
+        result = self.rules.get(rule)
+        if result is None:
+            with self.lock:
+                result = self.rules.setdefault(rule, RuleMetrics(rule))
+        return result
+
+    def fired(self, rule, duration):
+        self.rule(rule).fired(duration)
+
+    def rejected(self, rule):
+        self.rule(rule).rejected()
+
+    def sse_connected(self, delta):
+        with self.lock:
+            self.sse_clients += delta
+
+    def render(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+        with self.lock:
+            rules = list(self.rules.values())
+            contexts = list(self.contexts.items())
+
+        lines = []
+        def family(name, kind, description, samples):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.extend(samples)
+
+        family('eca_rule_fires_total', 'counter', 'Number of times the action of a rule was invoked.',
+               (_sample('eca_rule_fires_total', r.labels(), r.fires) for r in rules))
+        family('eca_rule_rejections_total', 'counter', 'Number of times the conditions of a rule did not hold.',
+               (_sample('eca_rule_rejections_total', r.labels(), r.rejections) for r in rules))
+        family('eca_rule_action_seconds', 'histogram', 'Time spent in the action of a rule.',
+               (s for r in rules for s in r.action_time.samples('eca_rule_action_seconds', r.labels())))
+
+        def labels(context):
+            return (('context', context.name),)
+
+        now = time.monotonic()
+        family('eca_context_queue_depth', 'gauge', 'Number of events waiting in the queue of a context.',
+               (_sample('eca_context_queue_depth', labels(c), len(c.event_queue)) for c, m in contexts))
+        family('eca_context_events_total', 'counter', 'Number of events handled by a context.',
+               (_sample('eca_context_events_total', labels(c), m.handled) for c, m in contexts))
+        family('eca_context_events_per_second', 'gauge', 'Average number of events handled per second since the context was created.',
+               (_sample('eca_context_events_per_second', labels(c), m.handled / max(now - m.started, 1e-9)) for c, m in contexts))
+        family('eca_context_dropped_total', 'counter', 'Number of events dropped by the queue of a context.',
+               (_sample('eca_context_dropped_total', labels(c), c.event_queue.dropped) for c, m in contexts))
+        family('eca_context_coalesced_total', 'counter', 'Number of events coalesced by the queue of a context.',
+               (_sample('eca_context_coalesced_total', labels(c), c.event_queue.coalesced) for c, m in contexts))
+        family('eca_context_dispatch_seconds', 'histogram', 'Time spent handling a single event.',
+               (s for c, m in contexts for s in m.dispatch_time.samples('eca_context_dispatch_seconds', labels(c))))
+
+        family('eca_sse_clients', 'gauge', 'Number of connected server side event clients.',
+               [_sample('eca_sse_clients', (), self.sse_clients)])
+        delayed = timers.wheel.pending + sum(s.pending for s in list(schedulers))
+        family('eca_delayed_events_pending', 'gauge', 'Number of delayed events waiting on the timer wheel or the asyncio engine.',
+               [_sample('eca_delayed_events_pending', (), delayed)])
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, file=None):
+        """Writes all metrics to the file (defaults to stdout)."""
+        file = file or sys.stdout
+        file.write(self.render())
+        file.flush()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    """Formats a single Prometheus sample."""
+    if labels:
+        label_text = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+        return "{}{{{}}} {}".format(name, label_text, value)
+    return "{} {}".format(name, value)
+
+
+# The active registry. Metrics are disabled when this is None.
+registry = None
+
+
+def enable():
+    """Enables metrics and returns the new registry."""
+    global registry
+    registry = Registry()
+    return registry
+
+
+def disable():
+    """Disables metrics."""
+    global registry
+    registry = None
@@ -0,0 +1,235 @@
+import time
+import weakref
+
+from . import Event, get_context, rules as default_rules
+from . import fields
+from . import queues
+from . import timers
+
+
+class Pattern:
+    """
+    Base class of patterns over multiple events.
+
+    A pattern attaches its own actions to the events it is built from, and
+    keeps its partial matches per context and per key. The key of an event is
+    the value of the given field of the event data, or the result of calling
+    key with the event if it is callable. Without a key, all events of a
+    context belong to the same partition. Derived events are fired at the
+    context in which the pattern completes.
+
+    Timers run on the shared timer wheel, but are handed to the context as
+    tasks, so partial matches are only ever touched by the thread that handles
+    the context's events.
+    """
+
+    def __init__(self, within, key, event):
+        self.within = within
+        self.key = key
+        self.event = event
+        self.states = weakref.WeakKeyDictionary()
+
+    def _key(self, event):
+        if self.key is None:
+            return None
+        if callable(self.key):
+            return self.key(event)
+        return fields.value(event, self.key)
+
+    def _state(self, context):
+        try:
+            return self.states[context]
+        except KeyError:
+            state = self.states[context] = {}
+            return state
+
+    def _attach(self, rules, eventname, handler):
+        def pattern(ctx, e):
+            handler(get_context(), e)
+        pattern.__qualname__ = pattern.__name__ = '{}_{}'.format(self.event, eventname).replace('-', '_')
+        rules.event(eventname)(pattern)
+
+    def _later(self, context, delay, function, *args):
+        """Runs function in the context after delay seconds."""
+        timers.schedule(delay, self._request, context, function, args)
+
+    def _request(self, context, function, args):
+        if not context.done:
+            context._enqueue(queues.Task(function, context, *args))
+
+    def _fire(self, context, data):
+        context.receive_event(Event(self.event, data))
+
+
+class Sequence(Pattern):
+    """
+    Detects a sequence of events with the same key within a time bound.
+
+    The pattern is compiled to an automaton with a state per step. A partial
+    match waits in the state of the next step it needs. When a matching event
+    arrives, the partial match advances to the next state; events that do not
+    match are skipped. Partial matches that reach the same state for the same
+    key are merged, keeping the one that started last, as it is the last to
+    expire. This bounds the number of partial matches to the number of steps
+    per key, no matter how many events arrive.
+
+    Partial matches expire once they are older than within seconds. A
+    periodic sweep forgets keys without live partial matches.
+    """
+
+    def __init__(self, steps, within, key, event, rules):
+        super().__init__(within, key, event)
+        self.sweeping = weakref.WeakSet()
+        self.steps = []
+        for step in steps:
+            if isinstance(step, str):
+                step = (step, None)
+            self.steps.append(step)
+
+        # each event name is handled once, for all steps it occurs in
+        names = {}
+        for i, (name, condition) in enumerate(self.steps):
+            names.setdefault(name, []).append(i)
+        for name, indices in names.items():
+            # visit later steps first, so an event advances a match only once
+            indices.reverse()
+            self._attach(rules, name, lambda context, e, indices=indices: self._advance(context, e, indices))
+
+    def _advance(self, context, event, indices):
+        state = self._state(context)
+        if self.within is not None and context not in self.sweeping:
+            self.sweeping.add(context)
+            self._later(context, self.within, self._sweep)
+
+        key = self._key(event)
+        moment = event.timestamp
+        runs = state.get(key)
+        last = len(self.steps) - 1
+
+        for i in indices:
+            condition = self.steps[i][1]
+            if condition is not None and not condition(context.scope, event):
+                continue
+
+            if i == 0:
+                run = (moment, (event, None))
+            else:
+                if runs is None or runs[i] is None:
+                    continue
+                start, chain = runs[i]
+                runs[i] = None
+                if self.within is not None and moment - start > self.within:
+                    continue
+                run = (start, (event, chain))
+
+            if i == last:
+                self._complete(context, key, run, moment)
+                continue
+
+            if runs is None:
+                runs = state[key] = [None] * len(self.steps)
+            waiting = runs[i + 1]
+            if waiting is None or waiting[0] <= run[0]:
+                runs[i + 1] = run
+
+    def _complete(self, context, key, run, moment):
+        start, chain = run
+        events = []
+        while chain is not None:
+            event, chain = chain
+            events.append({'name': event.name, 'data': event.data})
+        events.reverse()
+        self._fire(context, {
+            'key': key,
+            'events': events,
+            'duration': moment - start
+        })
+
+    def _sweep(self, context):
+        """Forgets expired partial matches."""
+        state = self._state(context)
+        horizon = time.monotonic() - self.within
+        for key, runs in list(state.items()):
+            for i, run in enumerate(runs):
+                if run is not None and run[0] < horizon:
+                    runs[i] = None
+            if not any(runs):
+                del state[key]
+        if state:
+            self._later(context, self.within, self._sweep)
+        else:
+            self.sweeping.discard(context)
+
+
+class Absence(Pattern):
+    """
+    Detects the absence of an event after another event.
+
+    After each trigger event, the missing event must arrive with the same key
+    within the given number of seconds. If the trigger and the missing event
+    are the same, this detects a silence of within seconds after the last
+    event, like a missing heartbeat. Each key has at most one pending
+    deadline, which is moved by every trigger event.
+    """
+
+    def __init__(self, trigger, missing, within, key, event, rules):
+        super().__init__(within, key, event)
+        self.trigger = trigger
+        self.missing = missing
+        if trigger != missing:
+            self._attach(rules, missing, self._arrived)
+        self._attach(rules, trigger, self._triggered)
+
+    def _triggered(self, context, event):
+        state = self._state(context)
+        key = self._key(event)
+        pending = state.get(key)
+        state[key] = [time.monotonic() + self.within, event]
+        if pending is None:
+            self._later(context, self.within, self._check, key)
+
+    def _arrived(self, context, event):
+        self._state(context).pop(self._key(event), None)
+
+    def _check(self, context, key):
+        state = self._state(context)
+        pending = state.get(key)
+        if pending is None:
+            return
+        deadline, event = pending
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            self._later(context, remaining, self._check, key)
+            return
+        del state[key]
+        self._fire(context, {
+            'key': key,
+            'last': {'name': event.name, 'data': event.data},
+            'within': self.within
+        })
+
+
+def sequence(*steps, within=None, key=None, fire, rules=default_rules):
+    """
+    Fires an event when the given steps occur in order.
+
+    Each step is an event name, or a pair of an event name and a condition
+    that must hold for the event. Only events with the same key are
+    correlated. If within is given, the whole sequence must occur within that
+    many seconds. The fired event carries the key, the names and data of the
+    matched events and the duration of the match.
+    """
+    return Sequence(steps, within, key, fire, rules)
+
+
+def absence(trigger, missing=None, within=None, key=None, fire=None, rules=default_rules):
+    """
+    Fires an event when missing does not occur within seconds after trigger.
+
+    Without missing, this fires when trigger itself does not occur again
+    within the given number of seconds. The fired event carries the key, the
+    name and data of the last trigger event and the time waited.
+    """
+    if within is None or fire is None:
+        raise ValueError("An absence pattern needs both 'within' and 'fire'.")
+    return Absence(trigger, missing or trigger, within, key, fire, rules)
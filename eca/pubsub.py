@@ -1,6 +1,7 @@
-import collections
 import threading
 
+from . import timers
+
 
 class PubSubChannel:
     """
@@ -9,42 +10,82 @@ class PubSubChannel:
     The operations on this channel are thread-safe, but subscribers
     are executed by the publishing thread. Use a queue to decouple the
     publishing thread from the consuming thread.
+
+    Subscriptions are kept in immutable tuples that are replaced on every
+    subscribe and unsubscribe. Publishing iterates over the current tuple
+    without taking a lock, so publishers never block each other.
+
+    Subscribers can restrict themselves to a set of keys for an event. Such
+    subscribers only receive publishes of that event with one of their keys,
+    which allows routing of events to interested subscribers only.
+
+    Delayed publishes are handed to the scheduler, which is called with the
+    delay, a callback and its arguments. By default this is the shared timer
+    wheel.
     """
 
-    def __init__(self):
-        self.lock = threading.RLock()
-        self.subscriptions = collections.defaultdict(list)
+    def __init__(self, scheduler=timers.schedule):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.routes = {}
+        self.scheduler = scheduler
 
-    def subscribe(self, target, event='message'):
+    def subscribe(self, target, event='message', keys=None):
         """
         Subscribe to an event.
 
-        The optional event name can be used to subscribe selectively.
+        The optional event name can be used to subscribe selectively. The
+        optional keys restrict the subscription to publishes with those keys.
         """
         with self.lock:
-            self.subscriptions[event].append(target)
+            if keys is None:
+                self.subscriptions[event] = self.subscriptions.get(event, ()) + (target,)
+            else:
+                for key in keys:
+                    route = (event, key)
+                    self.routes[route] = self.routes.get(route, ()) + (target,)
 
-    def unsubscribe(self, target, event='message'):
+    def unsubscribe(self, target, event='message', keys=None):
         """
         Unsubscribe from an event.
 
         The optional event name can be used to unsubscribe from another event.
+        The keys must be the same as the ones used to subscribe.
         """
+        def without(targets):
+            targets = list(targets)
+            targets.remove(target)
+            return tuple(targets)
+
         with self.lock:
-            self.subscriptions[event].remove(target)
+            if keys is None:
+                self.subscriptions[event] = without(self.subscriptions.get(event, ()))
+            else:
+                for key in keys:
+                    route = (event, key)
+                    targets = without(self.routes.get(route, ()))
+                    if targets:
+                        self.routes[route] = targets
+                    else:
+                        del self.routes[route]
 
-    def publish(self, event='message', data=None, delay=None):
+    def publish(self, event='message', data=None, delay=None, key=None):
         """
         Publishes an event.
 
         The event can be accompanied by optional data. A delay can be set to
-        delay the publish action by the given amount of seconds.
+        delay the publish action by the given amount of seconds. Delayed
+        publishes are run by the channel's scheduler. If a key is given, the
+        event is also published to the subscribers for that key.
+
+        Subscribers that unsubscribe while an event is published may still
+        receive that event.
         """
         if delay is None:
-            with self.lock:
-                for target in self.subscriptions[event]:
+            for target in self.subscriptions.get(event, ()):
+                target(event, data)
+            if key is not None:
+                for target in self.routes.get((event, key), ()):
                     target(event, data)
         else:
-            def task():
-                self.publish(event, data)
-            threading.Timer(delay, task).start()
+            self.scheduler(delay, self.publish, event, data, None, key)
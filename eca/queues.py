@@ -0,0 +1,186 @@
+import collections
+import threading
+
+
+# Sentinel put on a queue to wake up the consumer for immediate shutdown
+STOP = object()
+
+
+class Task:
+    """
+    Work to be run by the consumer of a queue, in order with the events.
+
+    Like STOP, tasks are control items: they are never dropped or coalesced.
+    """
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def run(self):
+        self.function(*self.args)
+
+
+def is_control(item):
+    """Determines if the item is a control item instead of an event."""
+    return item is STOP or item.__class__ is Task
+
+# Overflow policies for bounded queues
+BLOCK = 'block'
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+
+POLICIES = [BLOCK, DROP_NEWEST, DROP_OLDEST, COALESCE]
+
+# Thread local flag for threads that must never wait for a full queue
+_local = threading.local()
+
+
+def never_block():
+    """
+    Marks the calling thread as one that never waits for a full queue.
+
+    Threads that handle events (or run timers) must not wait, since they
+    could be waiting for themselves. For these threads the BLOCK policy
+    admits events beyond the capacity instead.
+    """
+    _local.never_block = True
+
+
+class EventQueue:
+    """
+    Priority-aware event queue for a single consuming thread.
+
+    Producers put events one at a time, but the consumer takes all pending
+    events at once. This keeps the number of lock round trips per event low
+    under load. The consumer is only woken up when the queue goes from empty
+    to non-empty.
+
+    Events with a higher priority are taken before events with a lower
+    priority. Events with the same priority are taken in FIFO order.
+
+    The queue can be bounded by a capacity. If a full queue receives an
+    event, the overflow policy decides what happens:
+      - BLOCK: the producer waits until the consumer has taken the pending
+        events.
+      - DROP_NEWEST: the new event is dropped.
+      - DROP_OLDEST: the oldest pending event with the lowest priority is
+        dropped. Control items are never dropped.
+      - COALESCE: the new event replaces the newest pending event with the
+        same name and priority. If there is no such event, the new event is
+        dropped.
+    The number of dropped and coalesced events is counted.
+    """
+
+    def __init__(self, capacity=None, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy '{}'".format(policy))
+        mutex = threading.Lock()
+        self.not_empty = threading.Condition(mutex)
+        self.not_full = threading.Condition(mutex)
+        self.levels = {0: collections.deque()}
+        self.priorities = [0]
+        self.count = 0
+        self.capacity = capacity
+        self.policy = policy
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return self.count
+
+    def _level(self, priority):
+        """Returns the deque for the given priority."""
+        items = self.levels.get(priority)
+        if items is None:
+            items = self.levels[priority] = collections.deque()
+            self.priorities = sorted(self.levels, reverse=True)
+        return items
+
+    def put(self, item, policy=None):
+        """
+        Puts an item on the queue.
+
+        The policy overrides the queue's overflow policy for this item.
+        Returns False if the item was dropped.
+        """
+        priority = getattr(item, 'priority', 0)
+        with self.not_full:
+            if self.capacity is not None and not is_control(item):
+                block = not getattr(_local, 'never_block', False)
+                coalesced = self.coalesced
+                if not self._admit(item, priority, policy or self.policy, block):
+                    return self.coalesced != coalesced
+
+            # look up the level only now, as the consumer may have taken the
+            # previous deque while the producer was waiting
+            self._level(priority).append(item)
+            self.count += 1
+            if self.count == 1:
+                self.not_empty.notify()
+            return True
+
+    def _admit(self, item, priority, policy, block):
+        """Applies the overflow policy. Returns True if item must be added."""
+        if policy == BLOCK:
+            while block and self.count >= self.capacity:
+                self.not_full.wait()
+            return True
+
+        if self.count < self.capacity:
+            return True
+
+        if policy == DROP_OLDEST:
+            # control items are never dropped
+            for priority in reversed(self.priorities):
+                pending = self.levels[priority]
+                for i, oldest in enumerate(pending):
+                    if not is_control(oldest):
+                        del pending[i]
+                        self.count -= 1
+                        self.dropped += 1
+                        return True
+
+        if policy == COALESCE:
+            items = self.levels.get(priority, ())
+            for i in range(len(items) - 1, -1, -1):
+                pending = items[i]
+                if not is_control(pending) and pending.name == item.name:
+                    items[i] = item
+                    self.coalesced += 1
+                    return False
+
+        self.dropped += 1
+        return False
+
+    def drain(self, block=True, limit=None):
+        """
+        Takes pending items from the queue, highest priority first.
+
+        If block is true, this waits until at least one item is available.
+        Otherwise, an empty sequence is returned if nothing is pending. At
+        most limit items are taken if a limit is given.
+        """
+        with self.not_empty:
+            if block:
+                while not self.count:
+                    self.not_empty.wait()
+
+            if len(self.levels[0]) == self.count and (limit is None or self.count <= limit):
+                # fast path: everything has the default priority, take it all
+                items = self.levels[0]
+                result = list(items)
+                items.clear()
+            else:
+                result = []
+                for priority in self.priorities:
+                    items = self.levels[priority]
+                    while items and (limit is None or len(result) < limit):
+                        result.append(items.popleft())
+            self.count -= len(result)
+
+            if self.capacity is not None:
+                self.not_full.notify_all()
+        return result
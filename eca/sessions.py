@@ -7,6 +7,7 @@ import random
 
 from . import httpd
 from . import Context, context_activate
+from . import queues
 
 
 # Name generation for contexts and sessions
@@ -100,10 +101,24 @@ class SessionManager:
     """
     The SessionManager class. This class is callable so it can be used in place
     of a constructor in the configuration.
+
+    Session contexts are run on the given executor, or on the default executor
+    if none is given. The capacity and overflow policy configure the event
+    queue of each session context. If a cluster is given, session contexts
+    are spawned on its worker processes instead. If a checkpointer is given,
+    returning sessions are restored from their last checkpoint. If a journal
+    is given, the events of all session contexts are recorded in it.
     """
-    def __init__(self, cookie_name):
+    def __init__(self, cookie_name, executor=None, capacity=None, overflow=queues.BLOCK, cluster=None, checkpointer=None,
+                 journal=None):
         self.sessions = {}
         self.cookie = cookie_name
+        self.executor = executor
+        self.capacity = capacity
+        self.overflow = overflow
+        self.cluster = cluster
+        self.checkpointer = checkpointer
+        self.journal = journal
 
     def __call__(self, *args, **kwargs):
         handler = SessionCookie(*args, **kwargs)
@@ -117,8 +132,14 @@ class SessionManager:
         return result
 
     def _new_session(self, name):
-        result = Session(Context(name=name, init_data={'name': name}), time.time())
-        result.context.start()
+        if self.cluster is not None:
+            context = self.cluster.spawn_context({'name': name}, name, capacity=self.capacity, overflow=self.overflow)
+            return Session(context, time.time())
+
+        context = Context(name=name, init_data={'name': name}, capacity=self.capacity,
+                          overflow=self.overflow, checkpointer=self.checkpointer, journal=self.journal)
+        result = Session(context, time.time())
+        result.context.start(executor=self.executor)
         return result
 
     def activate(self, name):
@@ -1,7 +1,8 @@
-import queue
 from collections import namedtuple
 
 from . import httpd
+from . import metrics
+from . import streams
 
 PendingEvent = namedtuple('PendingEvent', ['data', 'name', 'id'])
 
@@ -10,16 +11,26 @@ class ServerSideEvents(httpd.Handler):
     Base class for server side events. See the specification of the W3C
     at http://dev.w3.org/html5/eventsource/
     
-    This class handles decoupling through the default Queue. Events can be
-    posted for transmission by using send_event.
+    Once the response headers have been sent, the connection is handed over to
+    the stream hub, which multiplexes all event streams on a single thread,
+    and the request thread is released. Events can be posted for transmission
+    by using send_event from any thread.
     """
 
     def __init__(self, request):
         super().__init__(request)
-        self.queue = queue.Queue()
+        self.client = None
 
     def send_event(self, data, name=None, id=None):
-        self.queue.put(PendingEvent(data, name, id))
+        self.client.write(_encode(PendingEvent(data, name, id)))
+
+    def close(self):
+        """Ends the stream."""
+        self.client.close()
+
+    def last_event_id(self):
+        """Returns the id of the last event a reconnecting client has seen."""
+        return self.request.headers.get('Last-Event-ID')
 
     def go_subscribe(self):
         pass
@@ -28,40 +39,36 @@ class ServerSideEvents(httpd.Handler):
         pass
 
     def handle_GET(self):
-        self.go_subscribe()
-
         # Send HTTP headers:
         self.request.send_response(200)
         self.request.send_header("Content-type", "text/event-stream")
         self.request.end_headers()
+        self.request.wfile.flush()
 
-        done = False
-        while not done:
-            event = self.queue.get()
-            if event == None:
-                done = True
-            else:
-                done = not self._send_message(event)
-
-        self.go_unsubscribe()
-
-    def _send_message(self, event):
-        try:
-            if event.id is not None:
-                id_line = "id: {}\n".format(event.id)
-                self.request.wfile.write(id_line.encode('utf-8'))
-
-            if event.name is not None:
-                event_line = "event: {}\n".format(event.name)
-                self.request.wfile.write(event_line.encode('utf-8'))
-
-            data_line = "data: {}\n".format(event.data)
-            self.request.wfile.write(data_line.encode('utf-8'))
-
-            self.request.wfile.write("\n".encode('utf-8'))
-            self.request.wfile.flush()
+        registry = metrics.registry
+        if registry is not None:
+            registry.sse_connected(1)
+        self.client = streams.hub.client(self.request.connection, self._closed)
+        self.go_subscribe()
 
-            return True
-        except IOError:
-            return False
+        # hand the connection over to the stream hub
+        self.request.close_connection = True
+        self.request.server.detach(self.request.connection)
+        streams.hub.adopt(self.client)
 
+    def _closed(self):
+        self.go_unsubscribe()
+        registry = metrics.registry
+        if registry is not None:
+            registry.sse_connected(-1)
+
+
+def _encode(event):
+    """Encodes an event as a server side events message."""
+    lines = []
+    if event.id is not None:
+        lines.append("id: {}\n".format(event.id))
+    if event.name is not None:
+        lines.append("event: {}\n".format(event.name))
+    lines.append("data: {}\n\n".format(event.data))
+    return ''.join(lines).encode('utf-8')
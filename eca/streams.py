@@ -0,0 +1,213 @@
+import logging
+import selectors
+import socket
+import threading
+
+from . import queues
+
+logger = logging.getLogger(__name__)
+
+
+class Client:
+    """
+    A streaming connection owned by a StreamHub.
+
+    Writes are appended to the client's buffer and sent by the hub thread as
+    the socket accepts them, so writers never block on a slow client.
+    """
+
+    def __init__(self, hub, sock, closed):
+        self.hub = hub
+        self.sock = sock
+        self.closed = closed
+        self.buffer = bytearray()
+        self.adopted = False
+        self.done = False
+
+    def write(self, data):
+        """Queues data for sending. Returns False if the client is gone."""
+        return self.hub._write(self, data)
+
+    def close(self):
+        """Closes the connection once the hub gets to it."""
+        self.hub._request_close(self)
+
+
+class StreamHub:
+    """
+    Multiplexes long-lived streaming connections on a single thread.
+
+    HTTP handlers hand over their socket with adopt() once the response
+    headers have been sent. From then on, the hub sends all data with
+    non-blocking writes from a per-client write buffer, and notices when
+    clients disconnect. Clients that fall more than limit bytes behind are
+    evicted, so a stalled browser can not make the server buffer without
+    bound.
+
+    The thread is started on first use.
+    """
+
+    def __init__(self, limit=1 << 20):
+        self.limit = limit
+        self.selector = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+        # work handed to the hub thread by other threads
+        self.adopted = []
+        self.dirty = []
+        self.closing = []
+        self.woken = False
+
+    def _start(self):
+        self.selector = selectors.DefaultSelector()
+        self.waker, self.wakee = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+        self.selector.register(self.wakee, selectors.EVENT_READ)
+
+        self.thread = threading.Thread(target=self.run, name='eca-streams')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _wake(self):
+        """Wakes up the hub thread. Must be called with the lock held."""
+        if not self.woken:
+            self.woken = True
+            try:
+                self.waker.send(b'\0')
+            except BlockingIOError:
+                pass
+
+    def client(self, sock, closed=None):
+        """
+        Creates a client for a connected socket.
+
+        Data can be written to the client right away, but it is only sent once
+        the client has been adopted. The optional closed callable is called
+        without arguments when the connection has ended.
+        """
+        sock.setblocking(False)
+        return Client(self, sock, closed)
+
+    def adopt(self, client):
+        """Takes over the connection of a client."""
+        with self.lock:
+            if self.thread is None:
+                self._start()
+            self.adopted.append(client)
+            self._wake()
+
+    def _write(self, client, data):
+        with self.lock:
+            if client.done:
+                return False
+            idle = not client.buffer
+            client.buffer += data
+            if len(client.buffer) > self.limit:
+                logger.info("Evicting slow stream client {}".format(client.sock))
+                client.done = True
+                self.closing.append(client)
+                self._wake()
+            elif idle and client.adopted:
+                self.dirty.append(client)
+                self._wake()
+            return True
+
+    def _request_close(self, client):
+        with self.lock:
+            if not client.done:
+                client.done = True
+                self.closing.append(client)
+                self._wake()
+
+    def run(self):
+        """Hub main loop."""
+        queues.never_block()
+        while True:
+            for key, mask in self.selector.select():
+                client = key.data
+                if client is None:
+                    try:
+                        while self.wakee.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+
+                if mask & selectors.EVENT_READ:
+                    # clients do not send anything; readable means closed
+                    try:
+                        data = client.sock.recv(4096)
+                    except BlockingIOError:
+                        data = True
+                    except OSError:
+                        data = None
+                    if not data:
+                        self._close(client)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(client)
+
+            with self.lock:
+                adopted, self.adopted = self.adopted, []
+                dirty, self.dirty = self.dirty, []
+                closing, self.closing = self.closing, []
+                self.woken = False
+
+            for client in adopted:
+                client.adopted = True
+                self.selector.register(client.sock, selectors.EVENT_READ, client)
+                if client.done:
+                    closing.append(client)
+                else:
+                    dirty.append(client)
+            for client in dirty:
+                self._flush(client)
+            for client in closing:
+                self._close(client)
+
+    def _flush(self, client):
+        """Sends as much of the client's buffer as the socket accepts."""
+        with self.lock:
+            data = bytes(client.buffer)
+        if not data or client.sock.fileno() < 0:
+            return
+
+        try:
+            sent = client.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._close(client)
+            return
+
+        with self.lock:
+            del client.buffer[:sent]
+            pending = bool(client.buffer)
+
+        # wait for the socket to become writable if it could not take it all
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+        try:
+            self.selector.modify(client.sock, events, client)
+        except (KeyError, ValueError):
+            pass
+
+    def _close(self, client):
+        with self.lock:
+            client.done = True
+            client.buffer.clear()
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            return
+        try:
+            client.sock.close()
+        except OSError:
+            pass
+        if client.closed is not None:
+            client.closed()
+
+
+# The hub used for server side events
+hub = StreamHub()
@@ -0,0 +1,114 @@
+import logging
+import math
+import threading
+import time
+
+from . import queues
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel that runs delayed callbacks from a single thread.
+
+    Time is divided into ticks of the given resolution. Each timer is stored
+    in the slot of the tick in which it expires, so scheduling a timer takes
+    constant time. The wheel thread visits the slots as time passes and runs
+    all timers that are due in one batch. Timers that are further away than a
+    full revolution of the wheel stay in their slot until their tick comes
+    around.
+
+    The thread is started on first use, and sleeps while no timers are
+    pending.
+    """
+
+    def __init__(self, resolution=0.01, slots=512):
+        self.resolution = resolution
+        self.slots = [[] for i in range(slots)]
+        self.lock = threading.Condition(threading.Lock())
+        self.origin = time.monotonic()
+        self.current = 0
+        self.pending = 0
+        self.thread = None
+
+    def _tick(self, moment):
+        """Returns the tick that has started at the given moment."""
+        return int((moment - self.origin) / self.resolution)
+
+    def schedule(self, delay, callback, *args):
+        """
+        Schedules the callback to be called with args after delay seconds.
+
+        Timers never expire early, but may expire up to one tick late.
+        """
+        with self.lock:
+            tick = math.ceil((time.monotonic() + delay - self.origin) / self.resolution)
+            tick = max(tick, self.current + 1)
+            self.slots[tick % len(self.slots)].append((tick, callback, args))
+            self.pending += 1
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='eca-timers')
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.pending == 1:
+                self.lock.notify()
+
+    def _expire(self, now):
+        """Removes and returns all timers due at the given tick."""
+        due = []
+        count = len(self.slots)
+
+        # visit every slot between the last processed tick and now, but never
+        # visit a slot twice
+        for tick in range(max(self.current + 1, now - count + 1), now + 1):
+            slot = self.slots[tick % count]
+            if slot:
+                remaining = []
+                for timer in slot:
+                    if timer[0] <= now:
+                        due.append(timer)
+                    else:
+                        remaining.append(timer)
+                self.slots[tick % count] = remaining
+
+        self.current = now
+        self.pending -= len(due)
+
+        # run in order of expiry, and in order of scheduling within a tick
+        due.sort(key=lambda timer: timer[0])
+        return due
+
+    def run(self):
+        """Timer thread main loop."""
+        queues.never_block()
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+
+                moment = time.monotonic()
+                now = self._tick(moment)
+                if now <= self.current:
+                    # sleep until the next tick starts
+                    next_tick = self.origin + (self.current + 1) * self.resolution
+                    self.lock.wait(next_tick - moment)
+                    continue
+
+                due = self._expire(now)
+
+            for tick, callback, args in due:
+                try:
+                    callback(*args)
+                except Exception:
+                    logger.exception("Delayed callback {} failed".format(callback))
+
+
+# The shared timer wheel for all delayed events
+wheel = TimerWheel()
+
+
+def schedule(delay, callback, *args):
+    """Schedules a callback on the shared timer wheel."""
+    wheel.schedule(delay, callback, *args)
@@ -0,0 +1,70 @@
+import collections
+import logging
+import sys
+import time
+
+from . import util
+
+logger = logging.getLogger('trace')
+
+
+# A single trace record. The rule and duration are None for received events.
+TraceRecord = collections.namedtuple('TraceRecord', ['timestamp', 'context', 'event', 'rule', 'duration'])
+
+
+class TraceRecorder:
+    """
+    Fixed-size in-memory buffer of structured trace records.
+
+    Recording a trace only stores references; all formatting is deferred until
+    the records are dumped. When the buffer is full, the oldest records are
+    discarded. If log is true, each record is also written to the 'trace'
+    logger as it is recorded.
+    """
+
+    def __init__(self, size=10000, log=False):
+        self.records = collections.deque(maxlen=size)
+        self.log = log
+
+    def received(self, context, event):
+        """Records the receipt of an event by a context."""
+        self.records.append(TraceRecord(time.time(), context.name, event.name, None, None))
+        if self.log:
+            logger.info("Received event: {}".format(event))
+
+    def fired(self, context, event, rule, duration):
+        """Records the firing of a rule for an event."""
+        self.records.append(TraceRecord(time.time(), context.name, event.name, rule, duration))
+        if self.log:
+            logger.info("Rule: {} ({:.6f}s)".format(util.describe_function(rule), duration))
+
+    def dump(self, file=None):
+        """Writes all buffered records to the file (defaults to stderr)."""
+        file = file or sys.stderr
+        for record in list(self.records):
+            if record.rule is None:
+                message = "{:.6f} [{}] received '{}'"
+                file.write(message.format(record.timestamp, record.context, record.event) + '\n')
+            else:
+                message = "{:.6f} [{}] '{}' fired {} in {:.6f}s"
+                file.write(message.format(record.timestamp, record.context, record.event,
+                                          util.describe_function(record.rule), record.duration) + '\n')
+        file.flush()
+
+
+# The active recorder. Tracing is disabled when this is None, and costs no
+# more than checking this variable.
+recorder = None
+
+
+def enable(size=10000, log=False):
+    """Enables tracing and returns the new recorder."""
+    global recorder
+    recorder = TraceRecorder(size, log)
+    return recorder
+
+
+def disable():
+    """Disables tracing."""
+    global recorder
+    recorder = None
@@ -1,4 +1,6 @@
+import importlib
 import os.path
+import sys
 
 
 class NamespaceError(KeyError):
@@ -31,9 +33,30 @@ def describe_function(fn):
     
     This function is most useful when used on function defined in actual files.
     """
+    if not hasattr(fn, '__code__'):
+        return repr(fn)
+
     parts = []
     parts.append(fn.__name__)
 
     parts.append(" ({}:{})".format(os.path.relpath(fn.__code__.co_filename), fn.__code__.co_firstlineno))
 
     return ''.join(parts)
+
+
+def load_module(path):
+    """
+    Imports a Python module from the given file path.
+
+    The directory of the file is only temporarily added to the module search
+    path.
+    """
+    module_dir, module_file = os.path.split(path)
+    module_name = os.path.splitext(module_file)[0]
+
+    old_path = list(sys.path)
+    sys.path.insert(0, module_dir)
+    try:
+        return importlib.import_module(module_name)
+    finally:
+        sys.path[:] = old_path
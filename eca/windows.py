@@ -0,0 +1,226 @@
+import collections
+import time
+
+from . import Event, get_context
+from . import queues
+from . import timers
+
+
+class Aggregate:
+    """
+    Incremental count, sum, average, minimum and maximum over a sequence of
+    values that are added at the end and evicted from the front.
+
+    All operations take (amortised) constant time. Minimum and maximum are
+    kept in monotonic queues, so evicting the current extreme does not
+    require a scan of the remaining values.
+    """
+
+    def __init__(self):
+        self.values = collections.deque()
+        self.total = 0
+        self.minima = collections.deque()
+        self.maxima = collections.deque()
+
+    def add(self, value, moment):
+        self.values.append((moment, value))
+        self.total += value
+        while self.minima and self.minima[-1] > value:
+            self.minima.pop()
+        self.minima.append(value)
+        while self.maxima and self.maxima[-1] < value:
+            self.maxima.pop()
+        self.maxima.append(value)
+
+    def evict(self):
+        """Removes the oldest value."""
+        moment, value = self.values.popleft()
+        self.total -= value
+        if self.minima[0] == value:
+            self.minima.popleft()
+        if self.maxima[0] == value:
+            self.maxima.popleft()
+
+    def clear(self):
+        self.values.clear()
+        self.total = 0
+        self.minima.clear()
+        self.maxima.clear()
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def sum(self):
+        return self.total
+
+    @property
+    def avg(self):
+        return self.total / len(self.values) if self.values else None
+
+    @property
+    def min(self):
+        return self.minima[0] if self.minima else None
+
+    @property
+    def max(self):
+        return self.maxima[0] if self.maxima else None
+
+    def summary(self):
+        """Returns all aggregates as a dictionary."""
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.avg,
+            'min': self.min,
+            'max': self.max
+        }
+
+
+class Window(Aggregate):
+    """
+    Base class of windows.
+
+    Windows must be created inside a context, usually in an action. Timed
+    eviction runs on the shared timer wheel, but is handed to the context as
+    a task, so windows are only ever changed by the thread that handles the
+    context's events and need no locking. If an event name is given, the
+    event is fired at the context with the summary of the window when the
+    window closes. Windows that are no longer needed should be stopped, so
+    their timers end.
+    """
+
+    def __init__(self, event=None):
+        super().__init__()
+        self.context = get_context()
+        if self.context is None:
+            raise NotImplementedError("Can not create a window outside of a context.")
+        self.event = event
+        self.stopped = False
+
+    def add(self, value):
+        """Adds a value to the window."""
+        super().add(value, time.monotonic())
+
+    def _later(self, delay, function):
+        """Runs function in the context after delay seconds."""
+        timers.schedule(delay, self._request, function)
+
+    def _request(self, function):
+        if not self.stopped and not self.context.done:
+            self.context._enqueue(queues.Task(self._run, function))
+
+    def _run(self, function):
+        # the window may have been stopped while the task was queued
+        if not self.stopped:
+            function()
+
+    def stop(self):
+        """
+        Stops the timers of the window. The window keeps its values, but is no
+        longer evicted or closed on time.
+        """
+        self.stopped = True
+
+    def close(self):
+        """Closes the window, firing the close event and starting afresh."""
+        if self.event is not None:
+            self.context.receive_event(Event(self.event, self.summary()))
+        self.clear()
+
+
+class CountWindow(Window):
+    """
+    Window over the last size values.
+
+    A sliding window evicts the oldest value once it holds more than size
+    values. A tumbling window closes as soon as it holds size values.
+    """
+
+    def __init__(self, size, tumbling=False, event=None):
+        super().__init__(event)
+        self.size = size
+        self.tumbling = tumbling
+
+    def add(self, value):
+        super().add(value)
+        if self.tumbling:
+            if self.count >= self.size:
+                self.close()
+        elif self.count > self.size:
+            self.evict()
+
+
+class TimeWindow(Window):
+    """
+    Window over the values added in the last duration seconds.
+
+    A sliding window evicts values once they are older than duration, both
+    when values are added and on a timer, so an idle window empties itself.
+    A tumbling window closes every duration seconds, even when it is empty.
+    """
+
+    def __init__(self, duration, tumbling=False, event=None):
+        super().__init__(event)
+        self.duration = duration
+        self.tumbling = tumbling
+        self.timer = False
+        if tumbling:
+            self.closes = time.monotonic() + duration
+            self._later(duration, self._tumble)
+
+    def add(self, value):
+        super().add(value)
+        if not self.tumbling:
+            self._expire()
+
+    def _expire(self):
+        """Evicts expired values and schedules the next eviction."""
+        moment = time.monotonic()
+        while self.values and self.values[0][0] <= moment - self.duration:
+            self.evict()
+        if self.values and not self.timer:
+            self.timer = True
+            self._later(self.values[0][0] + self.duration - moment, self._evict)
+
+    def _evict(self):
+        self.timer = False
+        self._expire()
+
+    def _tumble(self):
+        self.close()
+        # schedule from the intended closing time, so windows do not drift
+        self.closes += self.duration
+        self._later(max(0, self.closes - time.monotonic()), self._tumble)
+
+
+class SessionWindow(Window):
+    """
+    Window over a burst of values.
+
+    The window closes when no value has been added for gap seconds.
+    """
+
+    def __init__(self, gap, event=None):
+        super().__init__(event)
+        self.gap = gap
+        self.timer = False
+
+    def add(self, value):
+        super().add(value)
+        if not self.timer:
+            self.timer = True
+            self._later(self.gap, self._check)
+
+    def _check(self):
+        if not self.values:
+            # closed in the meantime
+            self.timer = False
+            return
+        idle = time.monotonic() - self.values[-1][0]
+        if idle >= self.gap:
+            self.timer = False
+            self.close()
+        else:
+            self._later(self.gap - idle, self._check)
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
 import threading
-import importlib
 import os.path
 import sys
 import logging
+import signal
 import json
 
 from eca import *
+import eca
+import eca.executor
+import eca.aio
+import eca.queues
+import eca.tracing
+import eca.metrics
+import eca.util
+import eca.cluster
+import eca.checkpoint
+import eca.journal
 import eca.httpd
 import eca.http
 
@@ -50,7 +61,7 @@ def main_server(args, rules_module):
             root_path = os.path.join(rules_path, rules_module.root_content_path)
 
     # configure http server
-    httpd = eca.httpd.HTTPServer((args.ip, args.port))
+    httpd = eca.httpd.HTTPServer((args.ip, args.port), workers=args.http_workers, backlog=args.backlog)
 
     # default root route
     httpd.add_content('/', root_path)
@@ -58,14 +69,24 @@ def main_server(args, rules_module):
     # default events route
     httpd.add_route('/events', eca.http.EventStream)
 
+    # metrics route if requested
+    if args.metrics:
+        httpd.add_route('/metrics', eca.http.Metrics)
+
     # default handlers for cookies and sessions
     httpd.add_filter('/', eca.http.Cookies)
-    httpd.add_filter('/', eca.http.SessionManager('eca-session'))
+    httpd.add_filter('/', eca.http.SessionManager('eca-session', capacity=args.capacity, overflow=args.overflow,
+                                                     cluster=args.cluster, checkpointer=args.checkpointer,
+                                                     journal=args.journal))
 
     # invoke module specific configuration
     if hasattr(rules_module, 'add_request_handlers'):
         rules_module.add_request_handlers(httpd)
 
+    # start the asyncio engine before sessions are attached to it
+    if args.engine is not None:
+        args.engine.start()
+
     # start serving
     httpd.serve_forever()
 
@@ -74,23 +95,55 @@ def main_engine(args, rules_module):
     """
     Rules engine only entry point.
     """
-    # create context
-    context = Context(init_data={'name': '__main__'})
-    context.start(daemon=False)
+    # dump metrics when all is done
+    if args.metrics:
+        atexit.register(eca.metrics.registry.dump)
+
+    # create context (in a worker process if running a cluster)
+    if args.cluster is not None:
+        context = args.cluster.spawn_context({'name': '__main__'}, '__main__', False, args.capacity, args.overflow)
+    else:
+        context = Context(init_data={'name': '__main__'}, name='__main__', capacity=args.capacity,
+                          overflow=args.overflow, checkpointer=args.checkpointer, journal=args.journal)
 
     # attach printing emit listener to context    
     def emitter(name, event):
         print("emit '{}': {}".format(event.name, json.loads(event.get('json'))))
     context.channel.subscribe(emitter, 'emit')
 
-    # fire main event
-    with context_switch(context):
-        logger.info("Starting module '{}'...".format(args.file))
-        fire('main')
-        # then read each line and process
-        for line in sys.stdin:
-            fire('line', line)
-        fire('end-of-input')
+    def batch_emitter(name, events):
+        for event in events:
+            emitter(name, event)
+    context.channel.subscribe(batch_emitter, 'emit-batch')
+
+    def feed():
+        # fire main event
+        with context_switch(context):
+            logger.info("Starting module '{}'...".format(args.file))
+            fire('main')
+            if args.replay:
+                # replay journaled events instead of reading input
+                count = eca.journal.replay(args.replay, context, args.replay_rate, exclude=('main', 'end-of-input'))
+                logger.info("Replayed {} events from '{}'".format(count, args.replay))
+            else:
+                # then read each line and process
+                for line in sys.stdin:
+                    fire('line', line)
+            fire('end-of-input')
+
+    if args.cluster is not None:
+        feed()
+        context.wait()
+        args.cluster.stop()
+    elif args.engine is not None:
+        # the event loop runs in this thread, so input is read in another
+        thread = threading.Thread(target=feed)
+        thread.daemon = True
+        thread.start()
+        args.engine.run(context)
+    else:
+        context.start(daemon=False)
+        feed()
 
 
 def main():
@@ -106,7 +159,7 @@ def main():
     parser.add_argument('-t', '--trace',
                         default=False,
                         action='store_true',
-                        help='Trace the execution of rules.')
+                        help='Trace the execution of rules. Send SIGUSR1 to dump the most recent trace records.')
     parser.add_argument('-l', '--log',
                         default='warning',
                         help="The log level to use. One of {} (defaults to '%(default)s')".format(_hr_items(log_level.allowed)),
@@ -124,6 +177,71 @@ def main():
     parser.add_argument('-i', '--ip',
                         default='localhost',
                         help="The IP to bind the HTTP server to (defaults to '%(default)s'")
+    parser.add_argument('--http-workers',
+                        default=None,
+                        help="Handle HTTP connections on a fixed pool of N threads (defaults to a thread per connection)",
+                        metavar='N',
+                        type=int)
+    parser.add_argument('--backlog',
+                        default=None,
+                        help="The maximum number of HTTP connections waiting to be handled",
+                        metavar='N',
+                        type=int)
+    parser.add_argument('--pool',
+                        default=False,
+                        action='store_true',
+                        help='Run daemon contexts on a fixed pool of worker threads instead of one thread per context.')
+    parser.add_argument('--workers',
+                        default=None,
+                        help="The number of worker threads in the pool (defaults to the number of cores)",
+                        metavar='N',
+                        type=int)
+    parser.add_argument('--async',
+                        dest='asyncio',
+                        default=False,
+                        action='store_true',
+                        help='Run contexts as asyncio tasks and await async actions.')
+    parser.add_argument('-m', '--metrics',
+                        default=False,
+                        action='store_true',
+                        help='Collect performance metrics. These are served on /metrics, or printed on exit without a server.')
+    parser.add_argument('--processes',
+                        default=None,
+                        help="Run contexts on a cluster of N worker processes (the asyncio engine is not used in workers)",
+                        metavar='N',
+                        type=int)
+    parser.add_argument('--checkpoint',
+                        default=None,
+                        help="Checkpoint the scope of contexts to FILE and restore it on startup",
+                        metavar='FILE')
+    parser.add_argument('--checkpoint-interval',
+                        default=5.0,
+                        help="Seconds between checkpoints (defaults to %(default)s)",
+                        metavar='SECONDS',
+                        type=float)
+    parser.add_argument('--journal',
+                        dest='journal_file',
+                        default=None,
+                        help="Record all events accepted by contexts in the binary journal FILE",
+                        metavar='FILE')
+    parser.add_argument('--replay',
+                        default=None,
+                        help="Feed the events of journal FILE to the main context instead of reading input",
+                        metavar='FILE')
+    parser.add_argument('--replay-rate',
+                        default=None,
+                        help="Replay FACTOR times faster than recorded (defaults to as fast as possible)",
+                        metavar='FACTOR',
+                        type=float)
+    parser.add_argument('--capacity',
+                        default=None,
+                        help="The maximum number of pending events per context (defaults to unbounded)",
+                        metavar='N',
+                        type=int)
+    parser.add_argument('--overflow',
+                        default=eca.queues.BLOCK,
+                        choices=eca.queues.POLICIES,
+                        help="What to do with events for a full context (defaults to '%(default)s')")
     args = parser.parse_args()
 
     # set logging level
@@ -132,18 +250,42 @@ def main():
     # enable trace logger if requested
     if args.trace:
         logging.getLogger('trace').setLevel(logging.DEBUG)
+        recorder = eca.tracing.enable(log=True)
+
+        # dump the trace buffer on demand (where the platform supports it)
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: recorder.dump())
+
+    # enable metrics if requested
+    if args.metrics:
+        eca.metrics.enable()
+
+    # run contexts on the asyncio engine or a worker pool if requested
+    args.engine = None
+    if args.asyncio:
+        args.engine = eca.aio.AsyncEngine()
+        eca.use_executor(args.engine)
+    elif args.pool:
+        eca.use_executor(eca.executor.ContextExecutor(args.workers))
+
+    # start worker processes if requested
+    args.cluster = None
+    args.checkpointer = None
+    args.journal = None
+    if args.processes:
+        args.cluster = eca.cluster.Cluster(args.file, args.processes, args.workers if args.pool else None, args.log,
+                                           args.checkpoint, args.checkpoint_interval, args.journal_file)
+        eca.use_global_channel(args.cluster.global_channel)
+    else:
+        if args.checkpoint:
+            args.checkpointer = eca.checkpoint.Checkpointer(args.checkpoint, args.checkpoint_interval)
+        if args.journal_file:
+            args.journal = eca.journal.Journal(args.journal_file)
+            atexit.register(args.journal.close)
 
     # load module
-    rules_dir, rules_file = os.path.split(args.file)
-    rules_name = os.path.splitext(rules_file)[0]
-    
-    old_path = list(sys.path)
-    sys.path.insert(0, rules_dir)
-    try:
-        rules_module = importlib.import_module(rules_name)
-    finally:
-        sys.path[:] = old_path
-    
+    rules_module = eca.util.load_module(args.file)
+
     args.entry_point(args, rules_module)
 
 if __name__ == "__main__":
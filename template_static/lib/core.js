@@ -10,6 +10,27 @@ events = {};
 (function($, exports) {
     var e = new EventSource('/events');
 
+    // callbacks per event name, for the events unpacked from batches
+    var listeners = {};
+
+    // the server sends all emits made while handling one event in a single
+    // 'emit-batch' message, which holds a list of {event, data} objects
+    e.addEventListener('emit-batch', function(m) {
+        try {
+            var batch = JSON.parse(m.data);
+        } catch(err) {
+            console.exception("Received malformed message: ",err);
+            return;
+        }
+
+        for(var i = 0; i < batch.length; i++) {
+            var callbacks = listeners[batch[i].event] || [];
+            for(var j = 0; j < callbacks.length; j++) {
+                callbacks[j](batch[i].data);
+            }
+        }
+    });
+
     exports.connect = function(name, elements) {
         // wrap to allow selector, jQuery object and DOM nodes
         var $elements = $(elements);
@@ -21,6 +42,9 @@ events = {};
     };
 
     exports.listen = function(name, callback) {
+        // add listener for batched events
+        (listeners[name] = listeners[name] || []).push(callback);
+
         // add event listener to event stream
         e.addEventListener(name, function(m) {
             try {